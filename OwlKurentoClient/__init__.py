@@ -1 +1,2 @@
-from .client import KurentoClient
\ No newline at end of file
+from .client import KurentoClient
+from .pool import KurentoClientPool
\ No newline at end of file
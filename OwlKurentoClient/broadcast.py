@@ -0,0 +1,303 @@
+from OwlKurentoClient import media
+from OwlKurentoClient.transaction import NEW_REF_PREFIX
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastShard(object):
+  # One pipeline of a broadcast: a DispatcherOneToMany whose source port gets the
+  # presenter's media, either straight from the presenter or over an RTP bridge,
+  # and a hub port plus WebRtcEndpoint per viewer
+
+  def __init__(self, pipeline, dispatcher, source, capacity):
+    self.pipeline = pipeline
+    self.dispatcher = dispatcher
+    self.source = source
+    self.capacity = capacity
+    self.viewers = set()
+    # Viewers being set up on this shard
+    self.reserved = 0
+    # RtpEndpoint receiving the presenter's media, None on the presenter's own shard
+    self.bridge = None
+
+  def room(self):
+    return self.capacity - len(self.viewers) - self.reserved
+
+
+class Viewer(object):
+  __slots__ = ("shard", "endpoint", "port", "sdp_answer", "subscription")
+
+  def __init__(self, shard, endpoint, port):
+    self.shard = shard
+    self.endpoint = endpoint
+    self.port = port
+    self.sdp_answer = None
+    self.subscription = None
+
+
+# A presenter sent to any number of viewers. Viewers asking to join are queued and
+# set up by `concurrency` workers, each taking whatever queued up to `batch_size`
+# viewers at a time and creating them in one transaction, so a crowd joining at
+# once costs a few round trips per batch rather than several per viewer, and at
+# most concurrency * batch_size setups run at once.
+#
+# Every shard holds up to `viewers_per_shard` viewers. Further shards are pipelines
+# created through `pipelines`, the presenter's client by default or a KurentoCluster
+# to spread the audience over several media servers, and get the presenter's media
+# through an RtpEndpoint pair. Media servers bridged this way must reach each other.
+#
+#   broadcast = await Broadcast.build(client)
+#   presenter, answer = await broadcast.set_presenter(offer, on_presenter_candidates)
+#   viewer = await broadcast.join(viewer_offer, on_viewer_candidates)
+#   ... viewer.sdp_answer, viewer.endpoint.add_ice_candidate(candidate) ...
+#   await broadcast.leave(viewer)
+#
+# Candidate callbacks are called like those of WebRtcEndpoint.on_ice_candidates_event.
+class Broadcast(object):
+
+  @classmethod
+  async def build(cls, client, pipelines=None, viewers_per_shard=500, batch_size=50, concurrency=4):
+    self = cls()
+    self.pipelines = pipelines or client
+    self.viewers_per_shard = viewers_per_shard
+    self.batch_size = batch_size
+    self.presenter = None
+    # Elements of the presenter's pipeline that the presenter feeds: the source
+    # port of its shard and the RTP senders of the bridges to the other shards
+    self.presenter_sinks = []
+    self.shard_lock = asyncio.Lock()
+    # Queue of (sdp offer, candidate callback, Future) of viewers waiting to be set up
+    self.joins = asyncio.Queue()
+    self.closed = False
+
+    self.origin = await self._build_shard(await client.create_pipeline())
+    self.presenter_sinks.append(self.origin.source)
+    self.shards = [self.origin]
+    self.workers = [asyncio.ensure_future(self._setup_worker()) for _ in range(concurrency)]
+    return self
+
+  def __len__(self):
+    return sum(len(shard.viewers) for shard in self.shards)
+
+  async def _build_shard(self, pipeline):
+    async with pipeline.get_client().transaction():
+      dispatcher = await media.DispatcherOneToMany.build(pipeline)
+      source = await media.HubPort.build(pipeline, dispatcher)
+      await dispatcher.set_source(source)
+    return BroadcastShard(pipeline, dispatcher, source, self.viewers_per_shard)
+
+  async def set_presenter(self, sdp_offer, on_ice_candidates):
+    # Returns the presenter's WebRtcEndpoint and SDP answer, a previous presenter
+    # is released once the new one is connected
+    pipeline = self.origin.pipeline
+    sinks = list(self.presenter_sinks)
+    async with pipeline.get_client().transaction():
+      presenter = await media.WebRtcEndpoint.build(pipeline)
+      for sink in sinks:
+        await presenter.connect(sink)
+      answer = await presenter.process_offer(sdp_offer)
+
+    previous, self.presenter = self.presenter, presenter
+    # Bridges opened while the presenter was being built
+    for sink in self.presenter_sinks[len(sinks):]:
+      await presenter.connect(sink)
+
+    await presenter.on_ice_candidates_event(on_ice_candidates)
+    await presenter.gather_candidates()
+    if previous is not None:
+      await previous.release()
+    return presenter, await answer
+
+  async def join(self, sdp_offer, on_ice_candidates):
+    # Returns the Viewer once its endpoint answered sdp_offer and gathers candidates
+    if self.closed:
+      raise RuntimeError("Broadcast is closed")
+    future = asyncio.get_running_loop().create_future()
+    self.joins.put_nowait((sdp_offer, on_ice_candidates, future))
+    return await future
+
+  async def leave(self, viewer):
+    # Leaving twice, or after close(), does nothing
+    if viewer not in viewer.shard.viewers:
+      return
+    viewer.shard.viewers.discard(viewer)
+    await self._unsubscribe([viewer])
+    async with viewer.shard.pipeline.get_client().transaction():
+      await viewer.port.release()
+      await viewer.endpoint.release()
+
+  async def _setup_worker(self):
+    while True:
+      join = await self.joins.get()
+      try:
+        shard = await self._shard_with_room()
+      except Exception as e:
+        logger.warning(f"Could not open a broadcast shard: {e}")
+        if not join[2].done():
+          join[2].set_exception(e)
+        continue
+
+      # Whoever queued up while other batches were in flight comes along
+      batch = [join]
+      limit = min(self.batch_size, shard.room())
+      while len(batch) < limit and not self.joins.empty():
+        batch.append(self.joins.get_nowait())
+
+      shard.reserved += len(batch)
+      try:
+        await self._setup_viewers(shard, batch)
+      except Exception as e:
+        logger.warning(f"Failed to set up {len(batch)} viewers: {e}")
+        for _, _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+      finally:
+        shard.reserved -= len(batch)
+        for _, _, future in batch:
+          if not future.done():
+            future.set_exception(RuntimeError("Viewer setup did not complete"))
+
+  async def _shard_with_room(self):
+    for shard in self.shards:
+      if shard.room() > 0:
+        return shard
+
+    # One shard is opened at a time, workers waiting for it find room in it
+    async with self.shard_lock:
+      for shard in self.shards:
+        if shard.room() > 0:
+          return shard
+      shard = await self._build_shard(await self.pipelines.create_pipeline())
+      await self._bridge(shard)
+      self.shards.append(shard)
+      logger.info(f"Broadcast opened shard {len(self.shards)} on pipeline {shard.pipeline.id}")
+      return shard
+
+  async def _bridge(self, shard):
+    origin = self.origin.pipeline
+
+    async def _receiver():
+      async with shard.pipeline.get_client().transaction():
+        receiver = await media.RtpEndpoint.build(shard.pipeline)
+        await receiver.connect(shard.source)
+        offer = await receiver.generate_offer()
+      return receiver, await offer
+
+    sender, (receiver, offer) = await asyncio.gather(media.RtpEndpoint.build(origin), _receiver())
+    answer = await sender.process_offer(offer)
+    await receiver.process_answer(answer)
+    shard.bridge = receiver
+
+    self.presenter_sinks.append(sender)
+    if self.presenter is not None:
+      await self.presenter.connect(sender)
+
+  async def _setup_viewers(self, shard, batch):
+    pipeline = shard.pipeline
+    client = pipeline.get_client()
+
+    viewers = []
+    answers = []
+    error = None
+    try:
+      async with client.transaction():
+        for sdp_offer, _, _ in batch:
+          endpoint = await media.WebRtcEndpoint.build(pipeline)
+          port = await media.HubPort.build(pipeline, shard.dispatcher)
+          await port.connect(endpoint)
+          viewers.append(Viewer(shard, endpoint, port))
+          answers.append(await endpoint.process_offer(sdp_offer))
+    except Exception as e:
+      # One viewer's bad offer must not fail the others, each answer tells how its viewer did
+      logger.debug(f"Viewer batch committed with errors: {e}")
+      error = e
+
+    ready = []
+    failed = []
+    for viewer, answer, (_, on_ice_candidates, future) in zip(viewers, answers, batch):
+      if answer.cancelled() or answer.exception() is not None:
+        failed.append(viewer)
+        if not future.done():
+          future.set_exception(error if answer.cancelled() else answer.exception())
+        continue
+      viewer.sdp_answer = answer.result()
+      ready.append((viewer, on_ice_candidates, future))
+
+    if failed:
+      asyncio.ensure_future(self._release_viewers(failed))
+    if not ready:
+      return
+
+    try:
+      subscriptions = await asyncio.gather(
+        *[viewer.endpoint.on_ice_candidates_event(on_ice_candidates) for viewer, on_ice_candidates, _ in ready],
+        return_exceptions=True)
+      errors = []
+      for (viewer, _, _), subscription in zip(ready, subscriptions):
+        if isinstance(subscription, Exception):
+          errors.append(subscription)
+        else:
+          viewer.subscription = subscription
+      if errors:
+        raise errors[0]
+      async with client.transaction():
+        for viewer, _, _ in ready:
+          await viewer.endpoint.gather_candidates()
+    except Exception:
+      # Their futures fail with the error, nothing of them may stay on the shard
+      viewers = [viewer for viewer, _, _ in ready]
+      await self._unsubscribe(viewers)
+      await self._release_viewers(viewers)
+      raise
+
+    gave_up = []
+    for viewer, _, future in ready:
+      if future.done():
+        gave_up.append(viewer)
+        continue
+      shard.viewers.add(viewer)
+      future.set_result(viewer)
+    if gave_up:
+      asyncio.ensure_future(self._release_viewers(gave_up))
+
+  async def _unsubscribe(self, viewers):
+    results = await asyncio.gather(
+      *[viewer.endpoint.unsubscribe(viewer.subscription) for viewer in viewers if viewer.subscription is not None],
+      return_exceptions=True)
+    for viewer in viewers:
+      viewer.subscription = None
+    for result in results:
+      if isinstance(result, Exception):
+        logger.warning(f"Failed to unsubscribe a viewer: {result}")
+
+  async def _release_viewers(self, viewers):
+    # Whatever the failed batch did create, ids still "newref:" were never created
+    try:
+      async with viewers[0].shard.pipeline.get_client().transaction():
+        for viewer in viewers:
+          for media_object in (viewer.port, viewer.endpoint):
+            if not media_object.id.startswith(NEW_REF_PREFIX):
+              await media_object.release()
+    except Exception as e:
+      logger.warning(f"Failed to release {len(viewers)} viewers: {e}")
+
+  async def close(self):
+    # Releases every shard's pipeline, with the viewers and bridges in them
+    self.closed = True
+    for worker in self.workers:
+      worker.cancel()
+    while not self.joins.empty():
+      _, _, future = self.joins.get_nowait()
+      if not future.done():
+        future.set_exception(RuntimeError("Broadcast is closed"))
+
+    viewers = [viewer for shard in self.shards for viewer in shard.viewers]
+    for shard in self.shards:
+      shard.viewers = set()
+    await self._unsubscribe(viewers)
+
+    await asyncio.gather(*[shard.pipeline.release() for shard in self.shards], return_exceptions=True)
+    self.shards = []
@@ -1,20 +1,100 @@
-from OwlKurentoClient import media
+from OwlKurentoClient import media, ownership
 from OwlKurentoClient.transport import AsyncTransport
+from OwlKurentoClient.transaction import Transaction
+
+import asyncio
+import logging
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Seconds close() waits for owned pipelines to be released when the transport
+# has no timeout of its own
+RELEASE_TIMEOUT = 10
 
 class KurentoClient(object):
 
   @classmethod
-  async def build(self, url, transport=None):
+  async def build(self, url, transport=None, timeout=None, metrics=None, cache_getters=False, keepalive_interval=None):
     self = KurentoClient()
     self.url = url
-    self.transport = transport or await AsyncTransport.build(self.url)
+    self.transport = transport or await AsyncTransport.build(
+      self.url, timeout=timeout, metrics=metrics, keepalive_interval=keepalive_interval)
+    # Optional monitoring.AdmissionController consulted before creating pipelines
+    self.admission = None
+    # Pipelines this client created or adopted are released when it closes
+    self.registry = ownership.registry
+    # Dict in the form {MediaPipeline: None}, kept up to date by the registry
+    self.owned_pipelines = {}
+    # Media objects built through this client by id, held weakly: building an
+    # object for an id still in use returns the same object
+    self.objects = weakref.WeakValueDictionary()
+    # Remember values of getters that never change, such as getUri, until release
+    self.cache_getters = cache_getters
+    return self
+
+  def get_client(self):
     return self
 
   def get_transport(self):
-    return self.transport
+    # Inside a transaction block operations are queued instead of sent
+    return Transaction.current(self.transport) or self.transport
+
+  def lookup(self, id, cls=None):
+    media_object = self.objects.get(id)
+    if media_object is not None and cls is not None and not isinstance(media_object, cls):
+      return None
+    return media_object
+
+  def register(self, media_object):
+    self.objects[media_object.id] = media_object
+
+  def unregister(self, media_object):
+    if self.objects.get(media_object.id) is media_object:
+      del self.objects[media_object.id]
+
+  def adopt(self, pipeline):
+    # Takes over a pipeline, e.g. one built ahead of time by another client
+    self.registry.claim(pipeline, self)
+
+  async def release_owned(self):
+    pipelines = list(self.owned_pipelines)
+    if not pipelines:
+      return
+    failed = await ownership.release_pipelines(pipelines)
+    for pipeline in failed:
+      # Left for the ownership.Reaper to retry
+      logger.warning(f"Failed to release pipeline {pipeline.id}, leaving it to the reaper")
+      self.registry.claim(pipeline, None)
+
+  async def close(self):
+    try:
+      await self._release_owned_on_close()
+    finally:
+      # Pooled clients only close their session, the shared connection stays open
+      await self.transport.close()
+
+  async def _release_owned_on_close(self):
+    # An unreachable media server must not keep close() from returning, whatever
+    # can't be released in time is left to the reaper
+    if self.transport.available:
+      try:
+        await asyncio.wait_for(self.release_owned(), self.transport.timeout or RELEASE_TIMEOUT)
+      except asyncio.TimeoutError:
+        logger.warning(f"Timed out releasing {len(self.owned_pipelines)} pipelines, leaving them to the reaper")
+    for pipeline in list(self.owned_pipelines):
+      self.registry.claim(pipeline, None)
+
+  def transaction(self, timeout=None):
+    return Transaction(self.transport, timeout=timeout)
 
   async def create_pipeline(self):
+    if self.admission is not None:
+      await self.admission.admit()
     return await media.MediaPipeline.build(self)
 
   async def get_pipeline(self, id):
     return await media.MediaPipeline.build(self, id=id)
+
+  async def get_server_manager(self):
+    return await media.ServerManager.build(self, id=media.ServerManager.ID)
@@ -0,0 +1,180 @@
+from OwlKurentoClient.client import KurentoClient
+from OwlKurentoClient.monitoring import ServerMetricsSampler
+from OwlKurentoClient.transport import KurentoConnectionException, KurentoTimeoutException
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Errors that say something about the node rather than about the request
+NODE_ERRORS = (KurentoConnectionException, KurentoTimeoutException, OSError)
+
+
+class KurentoNode(object):
+  # One media server of a cluster, with the bookkeeping used to place pipelines on it
+
+  # Keeps nodes with no latency samples yet comparable to measured ones
+  LATENCY_FLOOR = 0.005
+
+  def __init__(self, url, latency_alpha=0.2):
+    self.url = url
+    self.client = None
+    self.healthy = False
+    self.failures = 0
+    # Smoothed RPC round trip in seconds, None until the first sample
+    self.latency = None
+    self.latency_alpha = latency_alpha
+    # Optional ServerMetricsSampler of the node
+    self.sampler = None
+
+  def record_latency(self, seconds):
+    if self.latency is None:
+      self.latency = seconds
+    else:
+      self.latency += self.latency_alpha * (seconds - self.latency)
+
+  def pipeline_count(self):
+    # Pipelines of the node's client that are not released yet, however they end up released
+    return len(self.client.owned_pipelines) if self.client is not None else 0
+
+  def load(self):
+    # A node twice as slow to answer gets about half the pipelines, and with
+    # server metrics a busier cpu weighs in the same way
+    load = (self.pipeline_count() + 1) * ((self.latency or 0) + self.LATENCY_FLOOR)
+    metrics = self.sampler.metrics if self.sampler else None
+    if metrics is not None and metrics.used_cpu is not None:
+      load *= 1 + metrics.used_cpu / 100
+    return load
+
+  def __repr__(self):
+    return f"KurentoNode({self.url}, healthy={self.healthy}, pipelines={self.pipeline_count()}, latency={self.latency})"
+
+
+# Spreads pipelines over several media servers. create_pipeline() places each new
+# pipeline on the healthy node with the lowest load, get_pipeline() routes back to
+# the node that owns an id. Nodes failing `max_failures` times in a row are left
+# out until a health check succeeds again.
+class KurentoCluster(object):
+
+  @classmethod
+  async def build(cls, urls, timeout=None, health_check_interval=5, max_failures=3, latency_alpha=0.2,
+                  load_fn=None, metrics_interval=None, keepalive_interval=None):
+    self = cls()
+    self.timeout = timeout
+    # Seconds between keepalive pings of each node's connection, which then marks
+    # a node unhealthy as soon as it misses them and provides its latency
+    self.keepalive_interval = keepalive_interval
+    # Seconds between ServerManager samples of each node, None leaves them out of placement
+    self.metrics_interval = metrics_interval
+    self.health_check_interval = health_check_interval
+    self.max_failures = max_failures
+    # load_fn(node) -> number, lower is preferred. Defaults to KurentoNode.load
+    self.load_fn = load_fn or KurentoNode.load
+    self.nodes = [KurentoNode(url, latency_alpha=latency_alpha) for url in urls]
+
+    await asyncio.gather(*[self._connect(node) for node in self.nodes])
+    if not self.healthy_nodes():
+      logger.warning("No media server of the cluster is reachable yet")
+    self.health_task = asyncio.create_task(self._health_worker()) if health_check_interval else None
+    return self
+
+  def healthy_nodes(self):
+    # A connection that is down, reconnecting or missing keepalive pings takes its
+    # node out right away, without waiting for health checks to fail
+    return [node for node in self.nodes if node.healthy and node.client.transport.available]
+
+  async def _connect(self, node):
+    try:
+      node.client = await KurentoClient.build(node.url, timeout=self.timeout, keepalive_interval=self.keepalive_interval)
+    except Exception as e:
+      logger.warning(f"Could not connect to {node.url}: {e}")
+      node.healthy = False
+      return
+    node.healthy = True
+    node.failures = 0
+
+    if self.metrics_interval:
+      try:
+        node.sampler = await ServerMetricsSampler.build(node.client, interval=self.metrics_interval)
+      except Exception as e:
+        logger.warning(f"Could not sample server metrics of {node.url}: {e}")
+
+  def _record_failure(self, node, error):
+    node.failures += 1
+    if node.healthy and node.failures >= self.max_failures:
+      logger.warning(f"Marking {node.url} unhealthy after {node.failures} failures: {error}")
+      node.healthy = False
+
+  def _record_success(self, node, seconds):
+    node.record_latency(seconds)
+    node.failures = 0
+    if not node.healthy:
+      logger.info(f"{node.url} is healthy again")
+      node.healthy = True
+
+  async def create_pipeline(self):
+    # Tries nodes from least to most loaded, a node failing is skipped over
+    last_error = None
+    for node in sorted(self.healthy_nodes(), key=self.load_fn):
+      started_at = time.monotonic()
+      try:
+        pipeline = await node.client.create_pipeline()
+      except NODE_ERRORS as e:
+        last_error = e
+        self._record_failure(node, e)
+        continue
+
+      self._record_success(node, time.monotonic() - started_at)
+      return pipeline
+
+    raise KurentoConnectionException(f"No healthy media server available: {last_error}")
+
+  def node_for(self, pipeline_id):
+    # The node whose client holds the pipeline, None once it is released
+    for node in self.nodes:
+      if node.client is not None and node.client.lookup(pipeline_id) is not None:
+        return node
+    return None
+
+  async def get_pipeline(self, id):
+    node = self.node_for(id)
+    if node is None:
+      raise KeyError(f"Pipeline {id} was not created through this cluster")
+    return await node.client.get_pipeline(id)
+
+  async def _health_worker(self):
+    while True:
+      await asyncio.sleep(self.health_check_interval)
+      await asyncio.gather(*[self._check(node) for node in self.nodes])
+
+  async def _check(self, node):
+    if node.client is None:
+      await self._connect(node)
+      return
+
+    transport = node.client.get_transport()
+    if transport.keepalive_interval and transport.rtt is not None:
+      # The connection pings on its own, there is no need for another ping
+      if transport.healthy:
+        self._record_success(node, transport.rtt)
+      else:
+        self._record_failure(node, KurentoConnectionException(f"{transport.missed_pings} keepalive pings missed"))
+      return
+
+    started_at = time.monotonic()
+    try:
+      await transport.ping(timeout=self.timeout or self.health_check_interval)
+    except Exception as e:
+      self._record_failure(node, e)
+    else:
+      self._record_success(node, time.monotonic() - started_at)
+
+  async def close(self):
+    if self.health_task:
+      self.health_task.cancel()
+    for node in self.nodes:
+      if node.sampler:
+        node.sampler.close()
+    await asyncio.gather(*[node.client.close() for node in self.nodes if node.client], return_exceptions=True)
@@ -0,0 +1,64 @@
+import json
+
+# Faster JSON libraries are used when installed, the standard library otherwise
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+
+# Codecs turn JSON-RPC messages into websocket text frames and back. decode()
+# accepts both str and bytes frames, so binary frames never need an extra copy
+class JsonCodec(object):
+  name = "json"
+
+  def encode(self, obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+  def decode(self, data):
+    return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+  name = "orjson"
+
+  def encode(self, obj):
+    # orjson produces bytes, which websockets would send as a binary frame
+    return orjson.dumps(obj).decode("utf-8")
+
+  def decode(self, data):
+    return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+  name = "ujson"
+
+  def encode(self, obj):
+    return ujson.dumps(obj, ensure_ascii=False)
+
+  def decode(self, data):
+    return ujson.loads(data)
+
+
+class PassthroughCodec(object):
+  # For in-process connections that carry the message dicts themselves, see loopback.py
+  name = "passthrough"
+
+  def encode(self, obj):
+    return obj
+
+  def decode(self, data):
+    return data
+
+
+def default_codec():
+  if orjson is not None:
+    return OrjsonCodec()
+  if ujson is not None:
+    return UjsonCodec()
+  return JsonCodec()
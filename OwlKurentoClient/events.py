@@ -0,0 +1,273 @@
+import asyncio
+import collections
+import inspect
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EventStreamClosed(Exception):
+  pass
+
+
+class Delivery(object):
+  # Callback runs inside the transport's read loop, a slow callback delays every response
+  INLINE = "inline"
+  # Callback runs in its own task, fed from a bounded per subscription queue
+  TASK = "task"
+  # Like TASK, but plain callbacks run on a thread pool executor
+  EXECUTOR = "executor"
+
+
+class Backpressure(object):
+  # A full queue discards its oldest event
+  DROP_OLDEST = "drop_oldest"
+  # A full queue replaces its newest event, the subscriber only sees the latest state
+  COALESCE = "coalesce"
+  # A full queue pauses the read loop until the subscriber catches up, nothing is
+  # lost. Opt in only for callbacks that never wait on an RPC of the same
+  # connection: while the read loop is paused no response is read, so such a
+  # callback waits forever, and with it every session sharing the connection
+  BLOCK = "block"
+
+
+class EventSubscriber(object):
+  # Delivers events of one subscription. Callbacks may be plain functions or
+  # return awaitables, which are awaited before the next event is delivered.
+  # A subscriber more than `maxsize` events behind loses the oldest ones by
+  # default, see Backpressure.BLOCK before asking for anything else
+
+  def __init__(self, fn, delivery=Delivery.TASK, maxsize=1000, policy=Backpressure.DROP_OLDEST, executor=None,
+               lag=None):
+    if maxsize < 1:
+      raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+
+    self.fn = fn
+    self.delivery = delivery
+    self.maxsize = maxsize
+    self.policy = policy
+    # None uses the loop's default executor
+    self.executor = executor
+    # Optional metrics.Histogram observing how long queued events waited
+    self.lag = lag
+    # Deque of (<time.monotonic() received or None>, data)
+    self.queue = collections.deque()
+    self.drainer = None
+    self.space = None
+    self.dropped = 0
+    self.coalesced = 0
+    self.closed = False
+
+  def deliver(self, data):
+    # Returns an awaitable when the read loop has to wait before going on
+    if self.closed:
+      return None
+    if self.delivery == Delivery.INLINE:
+      result = self.fn(data)
+      return result if inspect.isawaitable(result) else None
+
+    item = (time.monotonic() if self.lag is not None else None, data)
+    if len(self.queue) >= self.maxsize:
+      if self.policy == Backpressure.DROP_OLDEST:
+        self.queue.popleft()
+        self.dropped += 1
+      elif self.policy == Backpressure.COALESCE:
+        self.queue[-1] = item
+        self.coalesced += 1
+        return None
+      else:
+        return self._put_when_space(item)
+
+    self.queue.append(item)
+    self._start_drainer()
+    return None
+
+  async def _put_when_space(self, item):
+    if self.space is None:
+      self.space = asyncio.Event()
+    while len(self.queue) >= self.maxsize:
+      self.space.clear()
+      await self.space.wait()
+      if self.closed:
+        return
+    self.queue.append(item)
+    self._start_drainer()
+
+  def _start_drainer(self):
+    if self.drainer is None or self.drainer.done():
+      self.drainer = asyncio.ensure_future(self._drain())
+
+  async def _drain(self):
+    # Exits once the queue is empty, idle subscriptions don't keep a task around
+    while self.queue:
+      received_at, data = self.queue.popleft()
+      if self.space is not None:
+        self.space.set()
+      if received_at is not None:
+        self.lag.observe(time.monotonic() - received_at)
+
+      try:
+        await self._call(data)
+      except Exception:
+        logger.exception(f"Event callback {self.fn} failed")
+
+  async def _call(self, data):
+    if self.delivery == Delivery.EXECUTOR and not asyncio.iscoroutinefunction(self.fn):
+      result = await asyncio.get_running_loop().run_in_executor(self.executor, self.fn, data)
+    else:
+      result = self.fn(data)
+
+    if inspect.isawaitable(result):
+      await result
+
+  def close(self):
+    # A callback already running is left to finish, nothing queued is delivered
+    self.closed = True
+    self.queue.clear()
+    if self.space is not None:
+      self.space.set()
+
+
+# Pull based alternative to callbacks, backed by a bounded buffer:
+#
+#   async with endpoint.events("OnIceCandidate") as stream:
+#     candidates = await stream.get_many(50, max_wait=0.02)
+#
+#   async for event in endpoint.events("CodeFound"):
+#     ...
+#
+# The server side subscription is made when the block or loop is entered and
+# dropped again when it is left. Once the stream is closed, get() raises
+# EventStreamClosed when the buffer is empty and iteration ends.
+class EventStream(object):
+
+  def __init__(self, media_object, event_type, maxsize=1000, policy=Backpressure.DROP_OLDEST):
+    if maxsize < 1:
+      raise ValueError(f"maxsize must be at least 1, got {maxsize}")
+
+    self.media_object = media_object
+    self.event_type = event_type
+    self.maxsize = maxsize
+    self.policy = policy
+    self.buffer = collections.deque()
+    self.ready = asyncio.Event()
+    self.space = asyncio.Event()
+    self.subscription_id = None
+    self.dropped = 0
+    self.coalesced = 0
+    self.closed = False
+
+  async def open(self):
+    if self.subscription_id is None:
+      self.closed = False
+      # Inline delivery only appends to the buffer, it never holds up the read loop
+      # unless the BLOCK policy asks for it
+      self.subscription_id = await self.media_object.subscribe(
+        self.event_type, self._push, delivery=Delivery.INLINE)
+    return self
+
+  async def close(self):
+    # A read loop waiting for space lets go first, otherwise the unsubscribe
+    # response could never be read. Consumers waiting for events wake up
+    self.closed = True
+    self.space.set()
+    self.ready.set()
+    subscription_id, self.subscription_id = self.subscription_id, None
+    # Releasing the object already dropped its subscriptions
+    if subscription_id is not None and self.media_object.get_transport().is_subscribed(subscription_id):
+      await self.media_object.unsubscribe(subscription_id)
+
+  async def __aenter__(self):
+    return await self.open()
+
+  async def __aexit__(self, exc_type, exc, tb):
+    await self.close()
+
+  def __aiter__(self):
+    return self._iterate()
+
+  async def _iterate(self):
+    opened_here = self.subscription_id is None
+    if opened_here:
+      await self.open()
+    try:
+      while True:
+        try:
+          event = await self.get()
+        except EventStreamClosed:
+          return
+        yield event
+    finally:
+      if opened_here:
+        await self.close()
+
+  def __len__(self):
+    return len(self.buffer)
+
+  def _push(self, data, media_object):
+    if self.closed:
+      return None
+    if len(self.buffer) >= self.maxsize:
+      if self.policy == Backpressure.DROP_OLDEST:
+        self.buffer.popleft()
+        self.dropped += 1
+      elif self.policy == Backpressure.COALESCE:
+        self.buffer[-1] = data
+        self.coalesced += 1
+        return None
+      else:
+        return self._push_when_space(data)
+
+    self.buffer.append(data)
+    self.ready.set()
+    return None
+
+  async def _push_when_space(self, data):
+    while len(self.buffer) >= self.maxsize:
+      self.space.clear()
+      await self.space.wait()
+      if self.closed:
+        return
+    self.buffer.append(data)
+    self.ready.set()
+
+  def _take(self, n):
+    events = [self.buffer.popleft() for _ in range(min(n, len(self.buffer)))]
+    if not self.buffer:
+      self.ready.clear()
+    self.space.set()
+    return events
+
+  async def get(self):
+    while not self.buffer:
+      if self.closed:
+        raise EventStreamClosed(f"{self.event_type} stream is closed")
+      self.ready.clear()
+      await self.ready.wait()
+    return self._take(1)[0]
+
+  async def get_many(self, max_n, max_wait=None):
+    # Returns once max_n events are buffered or max_wait seconds have passed, with
+    # whatever is buffered by then, which may be nothing. Without max_wait it waits
+    # for the first event and returns what is buffered right away
+    loop = asyncio.get_running_loop()
+    expires_at = None if max_wait is None else loop.time() + max_wait
+
+    while len(self.buffer) < max_n and not self.closed:
+      if expires_at is None:
+        if self.buffer:
+          break
+        remaining = None
+      else:
+        remaining = expires_at - loop.time()
+        if remaining <= 0:
+          break
+
+      self.ready.clear()
+      try:
+        await asyncio.wait_for(self.ready.wait(), remaining)
+      except asyncio.TimeoutError:
+        break
+
+    return self._take(max_n)
@@ -0,0 +1,189 @@
+from OwlKurentoClient.codec import PassthroughCodec
+from OwlKurentoClient.transport import AsyncTransport
+
+import websockets
+
+import asyncio
+import collections
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_CLOSED = object()
+
+
+class LoopbackConnection(object):
+  # Stands in for a websocket, handing request dicts straight to an in-process
+  # handler with `async handle(request, push)`, like mock_server.MockKurento
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.inbox = asyncio.Queue()
+    self.tasks = set()
+    self.closed = False
+
+  async def send(self, request):
+    if self.closed:
+      raise ConnectionError("Loopback connection closed")
+    task = asyncio.ensure_future(self._answer(request))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def _answer(self, request):
+    response = await self.handler.handle(request, self.inbox.put_nowait)
+    if response is not None and not self.closed:
+      self.inbox.put_nowait(response)
+
+  async def recv(self):
+    message = await self.inbox.get()
+    if message is _CLOSED:
+      raise ConnectionError("Loopback connection closed")
+    return message
+
+  async def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    for task in self.tasks:
+      task.cancel()
+    self.inbox.put_nowait(_CLOSED)
+
+
+# AsyncTransport without sockets or JSON: requests go to an in-process handler as
+# dicts and its answers come back the same way. Everything above the connection,
+# pending requests, subscriptions, timeouts, metrics and tracing, is the regular
+# transport code, which makes it good for fast tests and for profiling the client
+# on its own:
+#
+#   transport = await LoopbackTransport.build(MockKurento())
+#   client = await KurentoClient.build(transport.url, transport=transport)
+class LoopbackTransport(AsyncTransport):
+
+  @classmethod
+  async def build(cls, handler, url="loopback://kurento", **options):
+    # options are passed on to AsyncTransport.build
+    async def connect(url):
+      return LoopbackConnection(handler)
+
+    self = await super().build(url, codec=PassthroughCodec(), connect=connect, **options)
+    self.handler = handler
+    return self
+
+  async def drop_connection(self):
+    # Closes the connection under the transport, which then reconnects
+    await self.ws.close()
+
+
+class RecordingConnection(object):
+  # Wraps a connection and writes every message going through it to a SessionRecorder
+
+  def __init__(self, ws, recorder):
+    self.ws = ws
+    self.recorder = recorder
+
+  async def send(self, message):
+    self.recorder.record("sent", message)
+    await self.ws.send(message)
+
+  async def recv(self):
+    message = await self.ws.recv()
+    self.recorder.record("received", message)
+    return message
+
+  async def close(self):
+    await self.ws.close()
+
+
+# Records the traffic of a real media server session to a JSON lines file, one
+# {"time": <seconds since start>, "direction": "sent" | "received", "message": {...}}
+# per line, for ReplayKurento to play back later:
+#
+#   recorder = SessionRecorder("session.jsonl")
+#   transport = await AsyncTransport.build(url, connect=recorder.connect)
+class SessionRecorder(object):
+
+  def __init__(self, path):
+    self.path = path
+    self.file = open(path, "a", buffering=1)
+    self.started_at = time.monotonic()
+
+  async def connect(self, url):
+    return RecordingConnection(await websockets.client.connect(url), self)
+
+  def record(self, direction, message):
+    if isinstance(message, (str, bytes)):
+      message = json.loads(message)
+    entry = {"time": time.monotonic() - self.started_at, "direction": direction, "message": message}
+    self.file.write(json.dumps(entry) + "\n")
+
+  def close(self):
+    self.file.close()
+
+
+# Answers requests from a SessionRecorder file, for use as a LoopbackTransport or
+# MockKurentoServer handler. Requests are matched on method and params, ignoring
+# request and session ids, in the order they were recorded. Since every object id
+# the client sees comes from the recording, a client doing the same work sends the
+# same requests. Events recorded after a response are pushed right after replaying it.
+#
+# With speed=None everything is answered at once, otherwise recorded response times
+# are kept, divided by speed.
+class ReplayKurento(object):
+
+  def __init__(self, path, speed=None):
+    self.speed = speed
+    # Dict in the form {<request key>: deque of (<seconds to answer>, response, [events])}
+    self.exchanges = {}
+    self.unmatched = 0
+    self._load(path)
+
+  def _load(self, path):
+    with open(path) as f:
+      entries = [json.loads(line) for line in f if line.strip()]
+
+    # Dict in the form {<request id>: (<request key>, <time sent>)}
+    requests = {}
+    last_exchange = None
+    for entry in entries:
+      message = entry["message"]
+      if entry["direction"] == "sent":
+        if "id" in message and message.get("method") != "connect":
+          requests[message["id"]] = (_request_key(message), entry["time"])
+        continue
+
+      if "id" in message and message["id"] in requests:
+        key, sent_at = requests.pop(message["id"])
+        last_exchange = (entry["time"] - sent_at, message, [])
+        self.exchanges.setdefault(key, collections.deque()).append(last_exchange)
+      elif message.get("method") == "onEvent" and last_exchange is not None:
+        last_exchange[2].append(message)
+
+  def remaining(self):
+    return sum(len(exchanges) for exchanges in self.exchanges.values())
+
+  async def handle(self, request, push):
+    if request.get("method") == "connect":
+      return {"jsonrpc": "2.0", "id": request.get("id"), "result": {"sessionId": request.get("params", {}).get("sessionId")}}
+
+    exchanges = self.exchanges.get(_request_key(request))
+    if not exchanges:
+      self.unmatched += 1
+      logger.warning("No recorded response for %s", request.get("method"))
+      error = {"code": -32603, "message": f"No recorded response for {request.get('method')}"}
+      return {"jsonrpc": "2.0", "id": request.get("id"), "error": error}
+
+    elapsed, response, events = exchanges.popleft()
+    if self.speed:
+      await asyncio.sleep(elapsed / self.speed)
+
+    if events:
+      # Runs once the response is on its way
+      asyncio.get_running_loop().call_soon(lambda: [push(event) for event in events])
+    return dict(response, id=request.get("id"))
+
+
+def _request_key(request):
+  params = {key: value for key, value in (request.get("params") or {}).items() if key != "sessionId"}
+  return json.dumps([request.get("method"), params], sort_keys=True)
@@ -1,3 +1,9 @@
+from OwlKurentoClient.events import Delivery, EventStream
+from OwlKurentoClient.transaction import Transaction
+from OwlKurentoClient.transport import KurentoTransportException
+
+import asyncio
+import inspect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -14,45 +20,173 @@ class MediaType(object):
   DATA = "DATA"
 
 class MediaObject(object):
+  # Slots keep the many objects a busy client holds small, subclasses declare
+  # their own, empty unless they add attributes
+  __slots__ = ("parent", "options", "id", "_client", "_pipeline", "_cache", "__weakref__")
 
   @classmethod
-  async def build(cls, parent, **args):
-    self = cls()
-    self.parent = parent
-    self.options = args
+  async def build(cls, parent, timeout=None, **args):
     if 'id' in args:
-      logger.debug(f"Creating existing {self.__class__.__name__} with id={args['id']}",)
+      # An id the client already holds resolves to the same object
+      existing = parent.get_client().lookup(args['id'], cls)
+      if existing is not None:
+        return existing
+
+      logger.debug("Creating existing %s with id=%s", cls.__name__, args['id'])
+      self = cls()
+      self._setup(parent, None, existing=True)
       self.id = args['id']
+      self._client.register(self)
     else:
-      logger.debug(f"Creating new {self.__class__.__name__}")
-      self.id = await self.get_transport().create(self.__class__.__name__, **args)
+      logger.debug("Creating new %s", cls.__name__)
+      self = cls()
+      self._setup(parent, args, existing=False)
+      transport = self.get_transport()
+      self.id = await transport.create(cls.__name__, timeout=timeout, **args)
+      if isinstance(transport, Transaction):
+        # Registered once the commit tells the real id
+        transport.bind(self)
+      else:
+        self._client.register(self)
     return self
-  
+
+  def _setup(self, parent, options, existing):
+    self.parent = parent
+    # Constructor params of objects created here, None for existing ones
+    self.options = options
+    self._client = parent.get_client()
+    self._pipeline = None
+    # Dict in the form {"<getter>": value}, see _cached_invoke
+    self._cache = None
+
+  def get_client(self):
+    return self._client
+
   def get_transport(self):
-    return self.parent.get_transport()
+    return self._client.get_transport()
 
   def get_pipeline(self):
-    return self.parent.get_pipeline()
+    if self._pipeline is None:
+      self._pipeline = self.parent.get_pipeline()
+    return self._pipeline
 
   # todo: remove arguments that have a value of None to let optional params work seamlessly
-  async def invoke(self, method, **args):
-    return await self.get_transport().invoke(self.id, method, **args)
-
-  async def subscribe(self, event, fn):
+  async def invoke(self, method, timeout=None, **args):
+    return await self.get_transport().invoke(self.id, method, timeout=timeout, **args)
+
+  async def _cached_invoke(self, method):
+    # For getters whose value never changes once set. Cached only when the client
+    # has cache_getters on, dropped on release
+    if self._cache is not None and method in self._cache:
+      return self._cache[method]
+
+    value = await self.invoke(method)
+    # Inside a transaction the value is a future, and None usually means "not yet"
+    if self._client.cache_getters and value is not None and not asyncio.isfuture(value):
+      if self._cache is None:
+        self._cache = {}
+      self._cache[method] = value
+    return value
+
+  def _invalidate(self, *methods):
+    if self._cache is not None:
+      for method in methods:
+        self._cache.pop(method, None)
+
+  async def subscribe(self, event, fn, timeout=None, **delivery_options):
+    # fn may be a coroutine function, see events.EventSubscriber for delivery_options
     def _callback(value):
-      fn(value, self)
-    return await self.get_transport().subscribe(self.id, event, _callback)
+      return fn(value, self)
+    return await self.get_transport().subscribe(self.id, event, _callback, timeout=timeout, **delivery_options)
+
+  def events(self, event, **options):
+    # Async iterable of the object's events, see events.EventStream for options
+    return EventStream(self, event, **options)
+
+  async def unsubscribe(self, subscription_id, timeout=None):
+    return await self.get_transport().unsubscribe(subscription_id, timeout=timeout)
+
+  async def release(self, timeout=None):
+    return _when_done(await self.get_transport().release(self.id, timeout=timeout), self._released)
+
+  def _released(self):
+    self._cache = None
+    self._client.unregister(self)
+    # The server dropped the object's subscriptions with it
+    self._forget_subscriptions()
+
+  def _forget_subscriptions(self):
+    self._client.transport.forget_object(self.id)
+
 
-  async def release(self):
-    return await self.get_transport().release(self.id)
+def _when_done(result, fn):
+  # Calls fn right away, or inside a transaction once the operation's future succeeds
+  if asyncio.isfuture(result):
+    result.add_done_callback(lambda future: future.cancelled() or future.exception() or fn())
+  else:
+    fn()
+  return result
+
+
+class ServerManager(MediaObject):
+  # Every media server has exactly one, see KurentoClient.get_server_manager
+  __slots__ = ()
+  ID = "manager_ServerManager"
+
+  async def get_info(self):
+    return await self._cached_invoke("getInfo")
+
+  async def get_pipelines(self):
+    return await self.invoke("getPipelines")
+
+  async def get_sessions(self):
+    return await self.invoke("getSessions")
+
+  async def get_used_memory(self):
+    return await self.invoke("getUsedMemory")
+
+  async def get_cpu_count(self):
+    return await self._cached_invoke("getCpuCount")
+
+  async def get_used_cpu(self, interval):
+    # Percentage of cpu used, averaged by the server over `interval` milliseconds
+    return await self.invoke("getUsedCpu", interval=interval)
+
+  async def get_kmd(self, module_name):
+    return await self.invoke("getKmd", moduleName=module_name)
+
+  async def on_object_created_event(self, fn, **delivery_options):
+    return await self.subscribe("ObjectCreated", fn, **delivery_options)
+
+  async def on_object_destroyed_event(self, fn, **delivery_options):
+    return await self.subscribe("ObjectDestroyed", fn, **delivery_options)
 
 
 class MediaPipeline(MediaObject):
+  __slots__ = ()
+
+  @classmethod
+  async def build(cls, parent, **args):
+    self = await super().build(parent, **args)
+    # Pipelines looked up by id belong to whoever created them
+    if 'id' not in args:
+      self.get_client().adopt(self)
+    return self
+
   def get_pipeline(self):
     return self
 
+  def _released(self):
+    super()._released()
+    self._client.registry.forget(self)
+
+  def _forget_subscriptions(self):
+    # Releasing a pipeline releases everything in it
+    self._client.transport.forget_object(self.id, children=True)
+
 
 class MediaElement(MediaObject):
+  __slots__ = ()
 
   @classmethod
   async def build(cls, parent, **args):
@@ -80,8 +214,10 @@ class MediaElement(MediaObject):
 # ENDPOINTS
 
 class UriEndpoint(MediaElement):
+  __slots__ = ()
+
   async def get_uri(self):
-    return await self.invoke("getUri")
+    return await self._cached_invoke("getUri")
 
   async def pause(self):
     return await self.invoke("pause")
@@ -91,67 +227,174 @@ class UriEndpoint(MediaElement):
 
 
 class PlayerEndpoint(UriEndpoint):
+  __slots__ = ()
+
   async def play(self):
     return await self.invoke("play")
 
-  async def on_end_of_stream_event(self, fn):
-    return await self.subscribe("EndOfStream", fn)
+  async def on_end_of_stream_event(self, fn, **delivery_options):
+    return await self.subscribe("EndOfStream", fn, **delivery_options)
 
 
 class RecorderEndpoint(UriEndpoint):
+  __slots__ = ()
+
   async def record(self):
     return await self.invoke("record")
 
 
 class SessionEndpoint(MediaElement):
-  async def on_media_session_started_event(self, fn):
-    return await self.subscribe("MediaSessionStarted", fn)
+  __slots__ = ()
 
-  async def on_media_session_terminated_event(self, fn):
-    return await self.subscribe("MediaSessionTerminated", fn)
+  async def on_media_session_started_event(self, fn, **delivery_options):
+    return await self.subscribe("MediaSessionStarted", fn, **delivery_options)
+
+  async def on_media_session_terminated_event(self, fn, **delivery_options):
+    return await self.subscribe("MediaSessionTerminated", fn, **delivery_options)
 
 
 class HttpEndpoint(SessionEndpoint):
+  __slots__ = ()
+
   async def get_url(self):
-    return await self.invoke("getUrl")
+    return await self._cached_invoke("getUrl")
 
 
 class HttpGetEndpoint(HttpEndpoint):
-  pass
+  __slots__ = ()
 
 
 class HttpPostEndpoint(HttpEndpoint):
-  async def on_end_of_stream_event(self, fn):
-    return await self.subscribe("EndOfStream", fn)
+  __slots__ = ()
+
+  async def on_end_of_stream_event(self, fn, **delivery_options):
+    return await self.subscribe("EndOfStream", fn, **delivery_options)
 
 
 class SdpEndpoint(SessionEndpoint):
+  __slots__ = ()
+
+  # Session descriptors only change when negotiating again
+  DESCRIPTORS = ("getLocalSessionDescriptor", "getRemoteSessionDescriptor")
+
   async def generate_offer(self):
+    self._invalidate(*self.DESCRIPTORS)
     return await self.invoke("generateOffer")
 
   async def process_offer(self, offer):
+    self._invalidate(*self.DESCRIPTORS)
     return await self.invoke("processOffer", offer=offer)
 
   async def process_answer(self, answer):
+    self._invalidate(*self.DESCRIPTORS)
     return await self.invoke("processAnswer", answer=answer)
 
   async def get_local_session_descriptor(self):
-    return await self.invoke("getLocalSessionDescriptor")
+    return await self._cached_invoke("getLocalSessionDescriptor")
 
   async def get_remote_session_descriptor(self):
-    return await self.invoke("getRemoteSessionDescriptor")
+    return await self._cached_invoke("getRemoteSessionDescriptor")
 
 
 class RtpEndpoint(SdpEndpoint):
-  pass
+  __slots__ = ()
 
   
 class WebRtcEndpoint(SdpEndpoint):
-  async def on_add_ice_candidate_event(self, fn):
-    return await self.subscribe("OnIceCandidate", fn)
+  __slots__ = ("negotiated", "pending_candidates", "candidate_flush")
+
+  # Seconds ICE candidates are collected for before they are sent on together
+  ICE_CANDIDATE_WINDOW = 0.01
+
+  def _setup(self, parent, options, existing):
+    super()._setup(parent, options, existing)
+    # Remote candidates can only be added once the SDP exchange is done, existing
+    # endpoints are assumed to be past that point
+    self.negotiated = existing
+    self.pending_candidates = []
+    self.candidate_flush = None
+
+  async def process_offer(self, offer):
+    return self._negotiation_step(await super().process_offer(offer))
+
+  async def process_answer(self, answer):
+    return self._negotiation_step(await super().process_answer(answer))
+
+  def _negotiation_step(self, result):
+    # Inside a transaction the result is a future, the exchange is only done once it resolves
+    return _when_done(result, self._negotiation_done)
+
+  def _negotiation_done(self):
+    self.negotiated = True
+    if self.pending_candidates:
+      self._schedule_candidate_flush()
+
+  async def on_add_ice_candidate_event(self, fn, **delivery_options):
+    return await self.subscribe("OnIceCandidate", fn, **delivery_options)
+
+  async def on_ice_candidates_event(self, fn, window=None):
+    # Like on_add_ice_candidate_event, but fn(events, endpoint) receives every
+    # candidate gathered within `window` seconds of the first one at once
+    window = self.ICE_CANDIDATE_WINDOW if window is None else window
+    batch = []
+
+    def _deliver():
+      events = batch[:]
+      batch.clear()
+      result = fn(events, self)
+      if inspect.isawaitable(result):
+        asyncio.ensure_future(result)
+
+    def _collect(event, endpoint):
+      batch.append(event)
+      if len(batch) == 1:
+        asyncio.get_running_loop().call_later(window, _deliver)
+
+    return await self.subscribe("OnIceCandidate", _collect, delivery=Delivery.INLINE)
 
   async def add_ice_candidate(self, candidate):
-    return await self.invoke("addIceCandidate", candidate=candidate)
+    # Candidates are queued, held back until the SDP exchange is done and sent in
+    # batches. Await flush_ice_candidates() to know they were delivered
+    self.pending_candidates.append(candidate)
+    if self.negotiated:
+      self._schedule_candidate_flush()
+
+  async def add_ice_candidates(self, candidates):
+    self.pending_candidates.extend(candidates)
+    if self.negotiated and self.pending_candidates:
+      self._schedule_candidate_flush()
+
+  def _schedule_candidate_flush(self):
+    if self.candidate_flush is None:
+      self.candidate_flush = asyncio.get_running_loop().call_later(
+        self.ICE_CANDIDATE_WINDOW, lambda: asyncio.ensure_future(self._flush_in_background()))
+
+  async def _flush_in_background(self):
+    try:
+      await self.flush_ice_candidates()
+    except Exception as e:
+      logger.warning(f"Failed to add ICE candidates to {self.id}: {e}")
+
+  async def flush_ice_candidates(self):
+    if self.candidate_flush is not None:
+      self.candidate_flush.cancel()
+      self.candidate_flush = None
+
+    candidates, self.pending_candidates = self.pending_candidates, []
+    if not candidates:
+      return
+    if len(candidates) == 1:
+      return await self.invoke("addIceCandidate", candidate=candidates[0])
+
+    try:
+      async with self.get_client().transaction():
+        results = [await self.invoke("addIceCandidate", candidate=candidate) for candidate in candidates]
+      await asyncio.gather(*results)
+    except KurentoTransportException as e:
+      # Media servers without transaction support answer "method not found"
+      if e.response.get("error", {}).get("code") != -32601:
+        raise
+      await asyncio.gather(*[self.invoke("addIceCandidate", candidate=candidate) for candidate in candidates])
 
   async def gather_candidates(self):
     return await self.invoke("gatherCandidates")
@@ -159,33 +402,46 @@ class WebRtcEndpoint(SdpEndpoint):
 # FILTERS
 
 class GStreamerFilter(MediaElement):
-  pass
+  __slots__ = ()
 
 
 class FaceOverlayFilter(MediaElement):
+  __slots__ = ()
+
   async def set_overlayed_image(self, uri, offset_x, offset_y, width, height):
     return await self.invoke("setOverlayedImage", uri=uri, offsetXPercent=offset_x, offsetYPercent=offset_y, widthPercent=width, heightPercent=height)
 
 
 class ZBarFilter(MediaElement):
-  async def on_code_found_event(self, fn):
-    return await self.subscribe("CodeFound", fn)
+  __slots__ = ()
+
+  async def on_code_found_event(self, fn, **delivery_options):
+    return await self.subscribe("CodeFound", fn, **delivery_options)
 
 
 # HUBS
 class HubPort(MediaElement):
+  __slots__ = ()
+
   @classmethod
   async def build(cls, parent, hub, **args):
     args["hub"] = hub.id
     return await super().build(parent, **args)
 
 class Composite(MediaElement):
-  pass
+  __slots__ = ()
 
 
 class Dispatcher(MediaElement):
-  pass
+  __slots__ = ()
 
 
 class DispatcherOneToMany(MediaElement):
-  pass
+  __slots__ = ()
+
+  # Media reaching the source port goes out of every other port of the hub
+  async def set_source(self, source):
+    return await self.invoke("setSource", source=source.id)
+
+  async def remove_source(self):
+    return await self.invoke("removeSource")
@@ -0,0 +1,182 @@
+import bisect
+
+
+class Histogram(object):
+  # Fixed buckets, so observing is a binary search and two additions whatever the
+  # number of samples. Quantiles are estimated by interpolating within a bucket
+
+  # Seconds, from sub millisecond RPCs on a local media server to slow SDP negotiations
+  DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    # One count per bucket plus one for values over the last bound, not cumulative
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def quantile(self, q):
+    if not self.count:
+      return None
+
+    rank = q * self.count
+    seen = 0
+    for index, count in enumerate(self.counts):
+      if count and seen + count >= rank:
+        lower = self.buckets[index - 1] if index > 0 else 0.0
+        if index == len(self.buckets):
+          # Nothing to interpolate towards past the last bound
+          return lower
+        return lower + (self.buckets[index] - lower) * (rank - seen) / count
+      seen += count
+    return self.buckets[-1]
+
+  def cumulative(self):
+    # List of (<upper bound>, <count of values up to it>) the way Prometheus wants them
+    total = 0
+    result = []
+    for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+      total += count
+      result.append((bound, total))
+    return result
+
+  def as_dict(self):
+    return {
+      "count": self.count,
+      "sum": self.sum,
+      "mean": self.sum / self.count if self.count else None,
+      "p50": self.quantile(0.5),
+      "p90": self.quantile(0.9),
+      "p99": self.quantile(0.99)
+    }
+
+
+# Opt-in instrumentation of AsyncTransport, pass one as AsyncTransport.build(metrics=...).
+# A single instance may be shared by several transports, e.g. all connections of a
+# KurentoClientPool, to get totals. Everything is plain counters updated from the
+# event loop thread, cheap enough to be left on.
+#
+#   metrics = TransportMetrics()
+#   client = await KurentoClient.build(url, metrics=metrics)
+#   ...
+#   metrics.snapshot()["requests"]["invoke:processOffer"]["p99"]
+#   metrics.to_prometheus()
+class TransportMetrics(object):
+
+  def __init__(self, buckets=Histogram.DEFAULT_BUCKETS):
+    self.buckets = buckets
+    # Dict in the form {"<method>[:<operation or type>]": Histogram of round trips in seconds}
+    self.requests = {}
+    # Dict in the form {"<method>[:<operation or type>]": {"<error code>": count}}
+    self.errors = {}
+    self.in_flight = 0
+    # Characters of text frames and bytes of binary ones
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    # Dict in the form {"<event type>": count}
+    self.events = {}
+    # Seconds queued events waited between arriving and reaching their callback
+    self.event_lag = Histogram(buckets)
+
+  @staticmethod
+  def operation_key(rpc_type, args):
+    if rpc_type == "invoke":
+      return f"invoke:{args.get('operation')}"
+    if rpc_type == "create":
+      return f"create:{args.get('type')}"
+    if rpc_type == "subscribe":
+      return f"subscribe:{args.get('type')}"
+    return rpc_type
+
+  @staticmethod
+  def error_code(error):
+    # Kurento error codes for server errors, the failure kind for local ones
+    request_error = getattr(error, "response", None)
+    if isinstance(request_error, dict) and "error" in request_error:
+      return str(request_error["error"].get("code", "unknown"))
+    return type(error).__name__
+
+  def request_started(self):
+    self.in_flight += 1
+
+  def request_finished(self, key, seconds, error=None):
+    self.in_flight -= 1
+    histogram = self.requests.get(key)
+    if histogram is None:
+      histogram = self.requests[key] = Histogram(self.buckets)
+    histogram.observe(seconds)
+
+    if error is not None:
+      codes = self.errors.setdefault(key, {})
+      code = self.error_code(error)
+      codes[code] = codes.get(code, 0) + 1
+
+  def record_event(self, event_type):
+    self.events[event_type] = self.events.get(event_type, 0) + 1
+
+  def snapshot(self):
+    return {
+      "in_flight": self.in_flight,
+      "bytes_sent": self.bytes_sent,
+      "bytes_received": self.bytes_received,
+      "requests": {key: histogram.as_dict() for key, histogram in self.requests.items()},
+      "errors": {key: dict(codes) for key, codes in self.errors.items()},
+      "error_rates": {
+        key: sum(codes.values()) / self.requests[key].count
+        for key, codes in self.errors.items() if key in self.requests
+      },
+      "events": dict(self.events),
+      "event_lag": self.event_lag.as_dict()
+    }
+
+  def to_prometheus(self, prefix="kurento_client"):
+    # Prometheus text exposition format, version 0.0.4
+    lines = []
+
+    def header(name, kind, help):
+      lines.append(f"# HELP {prefix}_{name} {help}")
+      lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+    def histogram(name, histogram, labels=""):
+      separator = "," if labels else ""
+      for bound, count in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(float(bound))
+        lines.append(f'{prefix}_{name}_bucket{{{labels}{separator}le="{le}"}} {count}')
+      braces = f"{{{labels}}}" if labels else ""
+      lines.append(f"{prefix}_{name}_sum{braces} {histogram.sum}")
+      lines.append(f"{prefix}_{name}_count{braces} {histogram.count}")
+
+    header("rpc_duration_seconds", "histogram", "Round trip of JSON-RPC requests to the media server.")
+    for key, requests in sorted(self.requests.items()):
+      histogram("rpc_duration_seconds", requests, f'operation="{_escape(key)}"')
+
+    header("rpc_errors_total", "counter", "Failed JSON-RPC requests by error code.")
+    for key, codes in sorted(self.errors.items()):
+      for code, count in sorted(codes.items()):
+        lines.append(f'{prefix}_rpc_errors_total{{operation="{_escape(key)}",code="{_escape(code)}"}} {count}')
+
+    header("rpc_in_flight", "gauge", "JSON-RPC requests waiting for a response.")
+    lines.append(f"{prefix}_rpc_in_flight {self.in_flight}")
+
+    header("sent_bytes_total", "counter", "Size of the frames sent to the media server.")
+    lines.append(f"{prefix}_sent_bytes_total {self.bytes_sent}")
+    header("received_bytes_total", "counter", "Size of the frames received from the media server.")
+    lines.append(f"{prefix}_received_bytes_total {self.bytes_received}")
+
+    header("events_total", "counter", "Events received from the media server by type.")
+    for event_type, count in sorted(self.events.items()):
+      lines.append(f'{prefix}_events_total{{type="{_escape(event_type)}"}} {count}')
+
+    header("event_dispatch_lag_seconds", "histogram", "Time queued events waited for their callback.")
+    histogram("event_dispatch_lag_seconds", self.event_lag)
+
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+  return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,439 @@
+from OwlKurentoClient.codec import default_codec
+from OwlKurentoClient.transaction import NEW_REF_PREFIX
+
+import websockets
+
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Codes the media server answers with, and the JSON-RPC ones for malformed calls
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+SESSION_NOT_FOUND = -32000
+MEDIA_OBJECT_NOT_FOUND = 40101
+
+SERVER_MANAGER_ID = "manager_ServerManager"
+
+MOCK_SDP = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=Kurento Mock\r\nc=IN IP4 127.0.0.1\r\nt=0 0\r\n"
+
+
+class MockError(Exception):
+  def __init__(self, code, message):
+    super(MockError, self).__init__(message)
+    self.code = code
+
+
+class MockObject(object):
+
+  def __init__(self, id, type, params, pipeline=None):
+    self.id = id
+    self.type = type
+    self.params = params
+    # Id of the pipeline the object lives in, None for pipelines themselves
+    self.pipeline = pipeline
+    # Ids of the elements connected as sinks
+    self.sinks = set()
+    self.negotiated = False
+
+
+# Speaks the media server side of the Kurento JSON-RPC protocol without any media:
+# connect, ping, create, invoke, subscribe, unsubscribe, release and transaction,
+# with "newref:" references. Objects get Kurento style ids, SDP operations answer
+# with a fixed SDP, gatherCandidates emits OnIceCandidate events followed by
+# IceGatheringDone and play() emits EndOfStream after `play_duration` seconds.
+#
+# Responses are delayed by `latency` seconds, +/- up to `jitter`, and a fraction
+# `error_rate` of them fails. fail() makes specific operations fail on purpose.
+# Use it over websockets through MockKurentoServer or directly with handle().
+class MockKurento(object):
+
+  def __init__(self, latency=0, jitter=0, error_rate=0, candidates=3, play_duration=0.1, seed=None):
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    # Number of OnIceCandidate events each gatherCandidates emits
+    self.candidates = candidates
+    self.play_duration = play_duration
+    self.random = random.Random(seed)
+    # Dict in the form {"<object id>": MockObject}
+    self.objects = {}
+    # Dict in the form {"<session id>": set of subscription ids}
+    self.sessions = {}
+    # Dict in the form {"<subscription id>": ("<object id>", "<event type>", push)}
+    self.subscriptions = {}
+    # Dict in the form {"<method>[:<operation or type>]": [code, message, remaining times or None]}
+    self.failures = {}
+    self.requests = 0
+    self.tasks = set()
+    self.ids = itertools.count(1)
+
+  def fail(self, key, code=INTERNAL_ERROR, message="Injected failure", times=None):
+    # key is "invoke:processOffer", "create:WebRtcEndpoint", "release", ...
+    # times=None keeps failing until clear_failures()
+    self.failures[key] = [code, message, times]
+
+  def clear_failures(self):
+    self.failures = {}
+
+  def pipelines(self):
+    return [media_object.id for media_object in self.objects.values() if media_object.pipeline is None]
+
+  async def handle(self, request, push):
+    # push(message) sends a notification to the client the request came from.
+    # Returns the response, or None for notifications
+    self.requests += 1
+    await self._delay()
+    try:
+      result = self._execute(request, push, top_level=True)
+    except MockError as e:
+      response = {"code": e.code, "message": str(e)}
+      return {"jsonrpc": "2.0", "id": request.get("id"), "error": response}
+    if "id" not in request:
+      return None
+    return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+  async def _delay(self):
+    delay = self.latency
+    if self.jitter:
+      delay += self.random.uniform(-self.jitter, self.jitter)
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+  def _execute(self, request, push, top_level=False):
+    method = request.get("method")
+    params = request.get("params") or {}
+    handler = getattr(self, f"_{method}", None)
+    if handler is None:
+      raise MockError(METHOD_NOT_FOUND, f"Method not found: {method}")
+
+    self._inject_failure(method, params)
+    result = {}
+    value = handler(params, push)
+    if value is not None:
+      result["value"] = value
+    if top_level:
+      # Operations inside a transaction are answered without a session
+      result["sessionId"] = self._session(params)
+    return result
+
+  def _inject_failure(self, method, params):
+    if method in ("connect", "ping"):
+      return
+
+    key = method
+    if method == "invoke":
+      key = f"invoke:{params.get('operation')}"
+    elif method in ("create", "subscribe"):
+      key = f"{method}:{params.get('type')}"
+
+    if key not in self.failures:
+      key = method
+    failure = self.failures.get(key)
+    if failure is not None:
+      code, message, times = failure
+      if times is not None:
+        failure[2] -= 1
+        if failure[2] <= 0:
+          del self.failures[key]
+      raise MockError(code, message)
+
+    if self.error_rate and self.random.random() < self.error_rate:
+      raise MockError(INTERNAL_ERROR, "Injected random failure")
+
+  def _session(self, params):
+    session_id = params.get("sessionId")
+    if session_id is None:
+      session_id = str(uuid.uuid4())
+    self.sessions.setdefault(session_id, set())
+    return session_id
+
+  def _object(self, id):
+    media_object = self.objects.get(id)
+    if media_object is None:
+      raise MockError(MEDIA_OBJECT_NOT_FOUND, f"Object '{id}' not found")
+    return media_object
+
+  def _emit_later(self, delay, object_id, event_type, data=None):
+    async def emit():
+      await asyncio.sleep(delay)
+      self.emit(object_id, event_type, data)
+
+    task = asyncio.ensure_future(emit())
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  def emit(self, object_id, event_type, data=None):
+    # Sends an onEvent notification to every subscriber of the object's event type
+    data = dict(data or {}, source=object_id, type=event_type)
+    message = {
+      "jsonrpc": "2.0",
+      "method": "onEvent",
+      "params": {"value": {"data": data, "object": object_id, "type": event_type}}
+    }
+    for subscribed_object, subscribed_type, push in list(self.subscriptions.values()):
+      if subscribed_object == object_id and subscribed_type == event_type:
+        push(message)
+
+  # Protocol methods
+
+  def _connect(self, params, push):
+    session_id = params.get("sessionId")
+    if session_id is not None and session_id not in self.sessions:
+      raise MockError(SESSION_NOT_FOUND, f"Session '{session_id}' not found")
+    if session_id is not None:
+      # A resumed session gets its events on the connection it resumed on
+      for subscription_id in self.sessions[session_id]:
+        if subscription_id in self.subscriptions:
+          object_id, event_type, _ = self.subscriptions[subscription_id]
+          self.subscriptions[subscription_id] = (object_id, event_type, push)
+    return None
+
+  def _ping(self, params, push):
+    return "pong"
+
+  def _create(self, params, push):
+    type = params.get("type")
+    constructor_params = params.get("constructorParams") or {}
+    if not type:
+      raise MockError(INVALID_PARAMS, "Missing object type")
+
+    if type == "MediaPipeline":
+      id = f"{uuid.uuid4()}_kurento.MediaPipeline"
+      pipeline = None
+    else:
+      pipeline = constructor_params.get("mediaPipeline")
+      if pipeline is None:
+        raise MockError(INVALID_PARAMS, f"{type} needs a mediaPipeline")
+      self._object(pipeline)
+      if "hub" in constructor_params:
+        self._object(constructor_params["hub"])
+      id = f"{pipeline}/{uuid.uuid4()}_kurento.{type}"
+
+    self.objects[id] = MockObject(id, type, constructor_params, pipeline)
+    return id
+
+  def _invoke(self, params, push):
+    object_id = params.get("object")
+    operation = params.get("operation")
+    operation_params = params.get("operationParams") or {}
+    if object_id == SERVER_MANAGER_ID:
+      return self._server_manager(operation, operation_params)
+
+    media_object = self._object(object_id)
+    if operation in ("connect", "disconnect"):
+      sink = self._object(operation_params.get("sink")).id
+      if operation == "connect":
+        media_object.sinks.add(sink)
+      else:
+        media_object.sinks.discard(sink)
+      return None
+    if operation in ("processOffer", "processAnswer", "generateOffer"):
+      media_object.negotiated = True
+      return MOCK_SDP
+    if operation in ("getLocalSessionDescriptor", "getRemoteSessionDescriptor"):
+      return MOCK_SDP if media_object.negotiated else None
+    if operation == "gatherCandidates":
+      for index in range(self.candidates):
+        candidate = {
+          "candidate": f"candidate:{index} 1 UDP {2122260223 - index} 127.0.0.1 {40000 + index} typ host",
+          "sdpMid": "0",
+          "sdpMLineIndex": 0
+        }
+        self._emit_later(0.001 * (index + 1), object_id, "OnIceCandidate", {"candidate": candidate})
+      self._emit_later(0.001 * (self.candidates + 1), object_id, "IceGatheringDone")
+      return None
+    if operation == "play":
+      self._emit_later(self.play_duration, object_id, "EndOfStream")
+      return None
+    if operation in ("getUri", "getUrl"):
+      return media_object.params.get("uri") or f"http://127.0.0.1/{media_object.id}"
+    if operation == "getSinkConnections":
+      return [{"source": media_object.id, "sink": sink} for sink in sorted(media_object.sinks)]
+    if operation == "getSourceConnections":
+      return [{"source": source.id, "sink": media_object.id} for source in self.objects.values() if media_object.id in source.sinks]
+    if operation == "getMediaPipeline":
+      return media_object.pipeline or media_object.id
+    # addIceCandidate, record, stop, pause, set*Format... succeed without a value
+    return None
+
+  def _server_manager(self, operation, params):
+    if operation == "getPipelines":
+      return self.pipelines()
+    if operation == "getSessions":
+      return list(self.sessions)
+    if operation == "getUsedMemory":
+      return 65536 + 1024 * len(self.objects)
+    if operation == "getCpuCount":
+      return 4
+    if operation == "getUsedCpu":
+      return min(100.0, len(self.objects) * 0.5)
+    if operation == "getInfo":
+      return {"version": "mock", "modules": [], "type": "KMS"}
+    if operation == "getKmd":
+      return ""
+    raise MockError(METHOD_NOT_FOUND, f"ServerManager has no operation {operation}")
+
+  def _subscribe(self, params, push):
+    object_id = params.get("object")
+    if object_id != SERVER_MANAGER_ID:
+      self._object(object_id)
+    subscription_id = f"{next(self.ids)}_subscription"
+    self.subscriptions[subscription_id] = (object_id, params.get("type"), push)
+    if "sessionId" in params:
+      self.sessions.setdefault(params["sessionId"], set()).add(subscription_id)
+    return subscription_id
+
+  def _unsubscribe(self, params, push):
+    subscription_id = params.get("subscription")
+    if self.subscriptions.pop(subscription_id, None) is None:
+      raise MockError(INVALID_PARAMS, f"Subscription '{subscription_id}' not found")
+    return None
+
+  def _release(self, params, push):
+    media_object = self._object(params.get("object"))
+    released = [media_object.id]
+    if media_object.pipeline is None:
+      released.extend(id for id, child in self.objects.items() if child.pipeline == media_object.id)
+
+    for id in released:
+      del self.objects[id]
+    released = set(released)
+    for subscription_id, (object_id, _, _) in list(self.subscriptions.items()):
+      if object_id in released:
+        del self.subscriptions[subscription_id]
+    for remaining in self.objects.values():
+      remaining.sinks -= released
+    return None
+
+  def _transaction(self, params, push):
+    # Operations run in order, each answered on its own. A "newref:<id>" anywhere in
+    # the params refers to the object created by an earlier operation
+    created = {}
+    responses = []
+    for operation in params.get("operations") or []:
+      operation = dict(operation, params=_resolve_refs(operation.get("params") or {}, created))
+      try:
+        result = self._execute(operation, push)
+      except MockError as e:
+        responses.append({"jsonrpc": "2.0", "id": operation.get("id"), "error": {"code": e.code, "message": str(e)}})
+        continue
+      if operation.get("method") == "create":
+        created[f"{NEW_REF_PREFIX}{operation.get('id')}"] = result["value"]
+      responses.append({"jsonrpc": "2.0", "id": operation.get("id"), "result": result})
+    return responses
+
+
+def _resolve_refs(value, created):
+  if isinstance(value, str):
+    return created.get(value, value)
+  if isinstance(value, dict):
+    return {key: _resolve_refs(item, created) for key, item in value.items()}
+  if isinstance(value, list):
+    return [_resolve_refs(item, created) for item in value]
+  return value
+
+
+# Serves a MockKurento over websockets, so the transport, the media classes and the
+# example handlers can run without a media server:
+#
+#   server = await MockKurentoServer.build(port=0, latency=0.002, jitter=0.001)
+#   client = await KurentoClient.build(server.url)
+#
+# or from a shell, in place of a real media server:
+#
+#   python -m OwlKurentoClient.mock_server --port 8888 --latency 0.005
+class MockKurentoServer(object):
+
+  @classmethod
+  async def build(cls, host="127.0.0.1", port=8888, codec=None, kurento=None, **options):
+    self = cls()
+    self.codec = codec or default_codec()
+    # options are passed on to MockKurento
+    self.kurento = kurento or MockKurento(**options)
+    self.connections = set()
+    self.server = await websockets.serve(self._serve, host, port)
+    self.host = host
+    self.port = self.server.sockets[0].getsockname()[1]
+    return self
+
+  @property
+  def url(self):
+    return f"ws://{self.host}:{self.port}/kurento"
+
+  async def _serve(self, ws, path=None):
+    self.connections.add(ws)
+    tasks = set()
+
+    def push(message):
+      task = asyncio.ensure_future(ws.send(self.codec.encode(message)))
+      task.add_done_callback(_ignore_closed)
+
+    try:
+      async for frame in ws:
+        # Requests are answered concurrently, like the real server does
+        task = asyncio.ensure_future(self._answer(ws, frame, push))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    except Exception as e:
+      logger.debug("Mock connection closed: %s", e)
+    finally:
+      self.connections.discard(ws)
+      for task in tasks:
+        task.cancel()
+
+  async def _answer(self, ws, frame, push):
+    try:
+      request = self.codec.decode(frame)
+    except Exception:
+      response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": "Parse error"}}
+    else:
+      response = await self.kurento.handle(request, push)
+    if response is not None:
+      await ws.send(self.codec.encode(response))
+
+  async def drop_connections(self):
+    # Closes every client socket, to exercise reconnects
+    await asyncio.gather(*[ws.close() for ws in list(self.connections)], return_exceptions=True)
+
+  async def close(self):
+    self.server.close()
+    await self.server.wait_closed()
+
+
+def _ignore_closed(task):
+  if not task.cancelled():
+    task.exception()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Mock Kurento media server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8888)
+  parser.add_argument("--latency", type=float, default=0, help="seconds added to each response")
+  parser.add_argument("--jitter", type=float, default=0, help="seconds of random variation of the latency")
+  parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests that fail")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  async def serve():
+    server = await MockKurentoServer.build(
+      args.host, args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    logger.info(f"Mock media server listening on {server.url}")
+    await asyncio.Event().wait()
+
+  try:
+    asyncio.run(serve())
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
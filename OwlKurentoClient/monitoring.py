@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class KurentoAdmissionException(Exception):
+  def __init__(self, message, metrics=None):
+    super(KurentoAdmissionException, self).__init__(message)
+    self.metrics = metrics
+
+
+class ServerMetrics(object):
+
+  def __init__(self, pipelines, sessions, used_memory, cpu_count, used_cpu, sampled_at):
+    self.pipelines = pipelines
+    self.sessions = sessions
+    # KiB, as reported by the server
+    self.used_memory = used_memory
+    self.cpu_count = cpu_count
+    # Percentage of the whole machine
+    self.used_cpu = used_cpu
+    # time.monotonic() of the sample
+    self.sampled_at = sampled_at
+
+  def age(self):
+    return time.monotonic() - self.sampled_at
+
+  def as_dict(self):
+    return {
+      "pipelines": self.pipelines,
+      "sessions": self.sessions,
+      "used_memory": self.used_memory,
+      "cpu_count": self.cpu_count,
+      "used_cpu": self.used_cpu,
+      "age": self.age()
+    }
+
+
+# Polls a media server's ServerManager every `interval` seconds in the background
+# and keeps the latest ServerMetrics, so callers can read them without a round trip
+class ServerMetricsSampler(object):
+
+  @classmethod
+  async def build(cls, client, interval=5, cpu_interval=500):
+    self = cls()
+    self.interval = interval
+    # Milliseconds the server averages cpu usage over for each sample
+    self.cpu_interval = cpu_interval
+    self.server_manager = await client.get_server_manager()
+    self.metrics = None
+    # Set each time a new sample is stored
+    self.updated = asyncio.Event()
+    self.task = asyncio.create_task(self._worker())
+    return self
+
+  async def sample(self):
+    server_manager = self.server_manager
+    pipelines, sessions, used_memory, cpu_count, used_cpu = await asyncio.gather(
+      server_manager.get_pipelines(),
+      server_manager.get_sessions(),
+      server_manager.get_used_memory(),
+      server_manager.get_cpu_count(),
+      server_manager.get_used_cpu(self.cpu_interval))
+
+    self.metrics = ServerMetrics(
+      len(pipelines or []), len(sessions or []), used_memory, cpu_count, used_cpu, time.monotonic())
+    self.updated.set()
+    self.updated.clear()
+    return self.metrics
+
+  async def _worker(self):
+    while True:
+      try:
+        await self.sample()
+      except Exception as e:
+        logger.warning(f"Failed to sample server metrics: {e}")
+      await asyncio.sleep(self.interval)
+
+  async def wait_for_update(self, timeout=None):
+    await asyncio.wait_for(self.updated.wait(), timeout)
+    return self.metrics
+
+  def close(self):
+    self.task.cancel()
+
+
+# Decides from sampled metrics whether a new pipeline fits on the media server.
+# Set it as KurentoClient.admission and create_pipeline() calls admit() first: over
+# the limits it waits up to `queue_timeout` seconds for a sample showing room, then
+# raises KurentoAdmissionException. Without usable metrics everything is admitted.
+class AdmissionController(object):
+
+  def __init__(self, sampler, max_cpu=90, max_memory=None, max_pipelines=None, queue_timeout=0,
+               max_metrics_age=None):
+    self.sampler = sampler
+    self.max_cpu = max_cpu
+    self.max_memory = max_memory
+    self.max_pipelines = max_pipelines
+    self.queue_timeout = queue_timeout
+    # Samples older than this are ignored, defaults to three sampling intervals
+    self.max_metrics_age = max_metrics_age if max_metrics_age is not None else sampler.interval * 3
+    # Pipelines admitted since the last sample, which it can't know about yet
+    self.admitted_since_sample = 0
+    self.last_sample = None
+
+  def _current_metrics(self):
+    metrics = self.sampler.metrics
+    if metrics is not self.last_sample:
+      self.last_sample = metrics
+      self.admitted_since_sample = 0
+    if metrics is None or metrics.age() > self.max_metrics_age:
+      return None
+    return metrics
+
+  def rejection_reason(self, metrics):
+    if self.max_cpu is not None and metrics.used_cpu is not None and metrics.used_cpu >= self.max_cpu:
+      return f"cpu usage {metrics.used_cpu:.1f}% over {self.max_cpu}%"
+    if self.max_memory is not None and metrics.used_memory is not None and metrics.used_memory >= self.max_memory:
+      return f"memory usage {metrics.used_memory}KiB over {self.max_memory}KiB"
+    if self.max_pipelines is not None and metrics.pipelines + self.admitted_since_sample >= self.max_pipelines:
+      return f"{metrics.pipelines + self.admitted_since_sample} pipelines, limit is {self.max_pipelines}"
+    return None
+
+  async def admit(self):
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + self.queue_timeout
+
+    while True:
+      metrics = self._current_metrics()
+      reason = self.rejection_reason(metrics) if metrics is not None else None
+      if reason is None:
+        self.admitted_since_sample += 1
+        return
+
+      remaining = expires_at - loop.time()
+      if remaining <= 0:
+        raise KurentoAdmissionException(f"Media server is saturated: {reason}", metrics)
+      try:
+        await self.sampler.wait_for_update(remaining)
+      except asyncio.TimeoutError:
+        raise KurentoAdmissionException(f"Media server is saturated: {reason}", metrics) from None
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Remembers which owner (a KurentoClient, usually one per signaling session) each
+# pipeline created by this process belongs to. Pipelines are the unit of ownership,
+# releasing one releases every element in it. A pipeline whose owner went away
+# without managing to release it stays registered with owner None until the
+# Reaper gets rid of it.
+class OwnershipRegistry(object):
+
+  def __init__(self):
+    # Dict in the form {MediaPipeline: owner or None}
+    self.owners = {}
+
+  def claim(self, pipeline, owner):
+    previous = self.owners.get(pipeline)
+    if previous is not None:
+      previous.owned_pipelines.pop(pipeline, None)
+
+    self.owners[pipeline] = owner
+    if owner is not None:
+      owner.owned_pipelines[pipeline] = None
+
+  def forget(self, pipeline):
+    owner = self.owners.pop(pipeline, None)
+    if owner is not None:
+      owner.owned_pipelines.pop(pipeline, None)
+
+  def orphans(self):
+    return [pipeline for pipeline, owner in self.owners.items() if owner is None]
+
+  def owned_ids(self):
+    return {pipeline.id for pipeline, owner in self.owners.items() if owner is not None}
+
+
+# Shared by every client of the process unless one is given its own
+registry = OwnershipRegistry()
+
+
+async def release_pipelines(pipelines):
+  # Releases with one transaction per client the pipelines were built with, returns
+  # the pipelines that could not be released
+  by_client = {}
+  for pipeline in pipelines:
+    by_client.setdefault(pipeline.get_client(), []).append(pipeline)
+
+  failed = []
+  for client, group in by_client.items():
+    results = []
+    try:
+      async with client.transaction():
+        for pipeline in group:
+          results.append(await pipeline.release())
+    except Exception as e:
+      # Every release has its own outcome, the first error alone says little
+      logger.debug("Bulk release of %s pipelines failed: %s", len(group), e)
+
+    # Lets the done callbacks of the releases run, which forget the pipelines and
+    # the subscriptions to anything in them
+    await asyncio.sleep(0)
+    for pipeline, result in zip(group, results):
+      if result.cancelled() or result.exception() is not None:
+        failed.append(pipeline)
+  return failed
+
+
+# Periodically compares the pipelines the media server has with the ones owned in
+# this process and releases the leftovers in bulk: pipelines whose owner is gone,
+# and with adopt_foreign=True also pipelines this process never created once they
+# have been unowned for `grace` seconds. Leave adopt_foreign off when other
+# processes share the media server. The registry is process wide, so only orphans
+# built through a client of the reaper's media server (same url) are looked at,
+# run one reaper per server of a KurentoCluster.
+class Reaper(object):
+
+  @classmethod
+  async def build(cls, client, registry=registry, interval=60, grace=120, adopt_foreign=False):
+    self = cls()
+    self.client = client
+    self.registry = registry
+    self.interval = interval
+    self.grace = grace
+    self.adopt_foreign = adopt_foreign
+    self.server_manager = await client.get_server_manager()
+    # Dict in the form {"<pipeline id>": time.monotonic() first seen unowned}
+    self.first_seen = {}
+    self.task = asyncio.create_task(self._worker())
+    return self
+
+  async def _worker(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      try:
+        await self.sweep()
+      except Exception as e:
+        logger.warning(f"Reaper sweep failed: {e}")
+
+  async def sweep(self):
+    server_ids = set(await self.server_manager.get_pipelines() or [])
+    owned_ids = self.registry.owned_ids()
+
+    # Orphans the server already dropped need no release
+    orphans = {}
+    for pipeline in self.registry.orphans():
+      if pipeline.get_client().url != self.client.url:
+        # Lives on another media server, whose reaper judges it
+        continue
+      if pipeline.id in server_ids:
+        orphans[pipeline.id] = pipeline
+      else:
+        self.registry.forget(pipeline)
+
+    now = time.monotonic()
+    leftovers = list(orphans.values())
+    if self.adopt_foreign:
+      foreign_ids = server_ids - owned_ids - set(orphans)
+      self.first_seen = {id: self.first_seen.get(id, now) for id in foreign_ids}
+      for id in foreign_ids:
+        if now - self.first_seen[id] >= self.grace:
+          leftovers.append(await self.client.get_pipeline(id))
+
+    if not leftovers:
+      return []
+
+    logger.info(f"Releasing {len(leftovers)} orphaned pipelines")
+    # Released pipelines drop out of the registry by themselves
+    await release_pipelines(leftovers)
+    for pipeline in leftovers:
+      self.first_seen.pop(pipeline.id, None)
+    return leftovers
+
+  def close(self):
+    self.task.cancel()
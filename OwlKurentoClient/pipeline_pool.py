@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Keeps ready-made pipelines of one Topology on the media server so a call can take
+# one without waiting for it to be built. Whenever fewer than `low` pipelines are
+# ready the pool is refilled in the background up to `high`, and pipelines that sat
+# unused for longer than `idle_ttl` seconds are released again, down to `low`.
+# Pipelines handed out by acquire() belong to the caller and never return to the pool,
+# pass the caller's client as `owner` so they are released when it closes.
+class PipelinePool(object):
+
+  @classmethod
+  async def build(cls, client, topology, low=2, high=5, idle_ttl=300, transaction=True):
+    if not 0 <= low <= high:
+      raise ValueError(f"Watermarks must satisfy 0 <= low <= high, got low={low} high={high}")
+
+    self = cls()
+    self.client = client
+    self.topology = topology
+    self.low = low
+    self.high = high
+    self.idle_ttl = idle_ttl
+    self.transaction = transaction
+    # Deque of (<monotonic time it became ready>, {"<name>": MediaObject}), newest on the right
+    self.ready = collections.deque()
+    self.building = 0
+    self.closed = False
+    self.refill_task = None
+    self.reaper_task = asyncio.create_task(self._reaper()) if idle_ttl else None
+    self._refill()
+    return self
+
+  def __len__(self):
+    return len(self.ready)
+
+  async def acquire(self, owner=None):
+    if self.closed:
+      raise RuntimeError("Pipeline pool is closed")
+
+    if self.ready:
+      # Newest first, so the oldest pipelines are the ones left to expire
+      _, objects = self.ready.pop()
+    else:
+      logger.info("Pipeline pool is empty, building a pipeline on demand")
+      objects = await self._build_one()
+
+    if owner is not None:
+      owner.adopt(objects[self.topology.PIPELINE])
+    if len(self.ready) + self.building < self.low:
+      self._refill()
+    return objects
+
+  def _refill(self):
+    if self.closed or (self.refill_task and not self.refill_task.done()):
+      return
+    self.refill_task = asyncio.create_task(self._refill_worker())
+
+  async def _refill_worker(self):
+    missing = self.high - len(self.ready) - self.building
+    if missing <= 0:
+      return
+
+    self.building += missing
+    try:
+      results = await asyncio.gather(*[self._build_one() for _ in range(missing)], return_exceptions=True)
+    finally:
+      self.building -= missing
+
+    for objects in results:
+      if isinstance(objects, Exception):
+        logger.warning(f"Failed to pre-build pipeline: {objects}")
+      elif self.closed:
+        await self._release(objects)
+      else:
+        self.ready.append((time.monotonic(), objects))
+
+  async def _build_one(self):
+    return await self.topology.build(self.client, transaction=self.transaction)
+
+  async def _reaper(self):
+    while True:
+      await asyncio.sleep(self.idle_ttl / 2)
+
+      expired = []
+      deadline = time.monotonic() - self.idle_ttl
+      while len(self.ready) > self.low and self.ready[0][0] < deadline:
+        _, objects = self.ready.popleft()
+        expired.append(objects)
+
+      if expired:
+        logger.debug(f"Releasing {len(expired)} idle pipelines")
+        await asyncio.gather(*[self._release(objects) for objects in expired])
+
+  async def _release(self, objects):
+    try:
+      await objects[self.topology.PIPELINE].release()
+    except Exception as e:
+      logger.warning(f"Failed to release pooled pipeline: {e}")
+
+  async def close(self):
+    self.closed = True
+    if self.reaper_task:
+      self.reaper_task.cancel()
+    # A refill in progress releases what it builds once it sees the pool closed
+    if self.refill_task:
+      await asyncio.gather(self.refill_task, return_exceptions=True)
+
+    ready, self.ready = self.ready, collections.deque()
+    await asyncio.gather(*[self._release(objects) for _, objects in ready])
@@ -0,0 +1,175 @@
+from OwlKurentoClient.client import KurentoClient
+from OwlKurentoClient.transport import AsyncTransport
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+
+# Seconds a closing session waits on each unsubscribe when it has no timeout of its own
+UNSUBSCRIBE_TIMEOUT = 10
+
+
+class TransportSession(object):
+  # A logical session multiplexed over a shared AsyncTransport. It only keeps track
+  # of what it subscribed to, so closing it cleans up after the session without
+  # touching the socket other sessions are still using
+
+  def __init__(self, pool, transport, timeout=None):
+    self.pool = pool
+    self.transport = transport
+    # Per session default RPC timeout, falls back to the transport's when None
+    self.timeout = timeout
+    self.subscription_ids = set()
+    self.closed = False
+
+  @property
+  def in_flight(self):
+    return self.transport.in_flight
+
+  @property
+  def healthy(self):
+    return self.transport.healthy
+
+  @property
+  def available(self):
+    return self.transport.available
+
+  @property
+  def rtt(self):
+    return self.transport.rtt
+
+  def _timeout(self, timeout):
+    return self.timeout if timeout is None else timeout
+
+  async def create(self, obj_type, timeout=None, **args):
+    return await self.transport.create(obj_type, timeout=self._timeout(timeout), **args)
+
+  async def invoke(self, object_id, operation, timeout=None, **args):
+    return await self.transport.invoke(object_id, operation, timeout=self._timeout(timeout), **args)
+
+  async def subscribe(self, object_id, event_type, fn, timeout=None, **delivery_options):
+    subscription_id = await self.transport.subscribe(
+      object_id, event_type, fn, timeout=self._timeout(timeout), **delivery_options)
+    self.subscription_ids.add(subscription_id)
+    return subscription_id
+
+  async def unsubscribe(self, subscription_id, timeout=None):
+    self.subscription_ids.discard(subscription_id)
+    return await self.transport.unsubscribe(subscription_id, timeout=self._timeout(timeout))
+
+  def is_subscribed(self, subscription_id):
+    return self.transport.is_subscribed(subscription_id)
+
+  async def release(self, object_id, timeout=None):
+    return await self.transport.release(object_id, timeout=self._timeout(timeout))
+
+  def forget_object(self, object_id, children=False):
+    dropped = self.transport.forget_object(object_id, children=children)
+    self.subscription_ids.difference_update(dropped)
+    return dropped
+
+  async def ping(self, interval=None, timeout=None):
+    return await self.transport.ping(interval=interval, timeout=self._timeout(timeout))
+
+  async def transaction(self, operations, timeout=None):
+    return await self.transport.transaction(operations, timeout=self._timeout(timeout))
+
+  async def close(self):
+    if self.closed:
+      return
+    self.closed = True
+
+    # Subscriptions to objects released through this session are already gone.
+    # Local delivery stops right away, the server is only given so long to answer
+    subscription_ids, self.subscription_ids = self.subscription_ids, set()
+    subscription_ids = [id for id in subscription_ids if id in self.transport.subscription_keys]
+    timeout = self._timeout(None) or UNSUBSCRIBE_TIMEOUT
+    results = await asyncio.gather(
+      *[self.transport.unsubscribe(subscription_id, timeout=timeout) for subscription_id in subscription_ids],
+      return_exceptions=True)
+    for result in results:
+      if isinstance(result, Exception):
+        logger.warning(f"Failed to unsubscribe while closing session: {result}")
+    self.pool._release_session(self)
+
+
+class KurentoClientPool(object):
+  # Process wide pool of AsyncTransport connections to one media server. Every
+  # client() call returns a KurentoClient bound to its own TransportSession,
+  # placed on the connection with the fewest requests in flight. Connections are
+  # opened lazily by the first `size` sessions
+
+  # Dict in the form {"<url>": KurentoClientPool}
+  pools = {}
+  _pools_lock = None
+
+  @classmethod
+  async def get(cls, url, size=DEFAULT_POOL_SIZE, timeout=None, metrics=None, keepalive_interval=None):
+    if cls._pools_lock is None:
+      cls._pools_lock = asyncio.Lock()
+
+    async with cls._pools_lock:
+      if url not in cls.pools:
+        cls.pools[url] = await cls.build(
+          url, size=size, timeout=timeout, metrics=metrics, keepalive_interval=keepalive_interval)
+      return cls.pools[url]
+
+  @classmethod
+  async def build(cls, url, size=DEFAULT_POOL_SIZE, timeout=None, metrics=None, keepalive_interval=None):
+    self = cls()
+    self.url = url
+    self.size = size
+    self.timeout = timeout
+    # Optional metrics.TransportMetrics shared by every connection of the pool
+    self.metrics = metrics
+    # Seconds between keepalive pings on each connection, None sends none
+    self.keepalive_interval = keepalive_interval
+    self.transports = []
+    # Dict in the form {AsyncTransport: <number of open sessions>}
+    self.session_counts = {}
+    self.lock = asyncio.Lock()
+    return self
+
+  async def client(self, timeout=None):
+    transport = await self._acquire_transport()
+    self.session_counts[transport] += 1
+    return await KurentoClient.build(self.url, transport=TransportSession(self, transport, timeout=timeout))
+
+  async def _acquire_transport(self):
+    async with self.lock:
+      if len(self.transports) < self.size:
+        logger.debug(f"Opening pooled connection {len(self.transports) + 1}/{self.size} to {self.url}")
+        transport = await AsyncTransport.build(
+          self.url, timeout=self.timeout, metrics=self.metrics, keepalive_interval=self.keepalive_interval)
+        self.transports.append(transport)
+        self.session_counts[transport] = 0
+        return transport
+
+    # Connections missing pings only get sessions when all of them do
+    return min(self.transports,
+      key=lambda transport: (not transport.healthy, transport.in_flight, self.session_counts[transport]))
+
+  @property
+  def healthy(self):
+    # True while any connection answers pings, or none was opened yet
+    return not self.transports or any(transport.healthy for transport in self.transports)
+
+  @property
+  def rtt(self):
+    # Best smoothed ping round trip among healthy connections, None without samples
+    rtts = [transport.rtt for transport in self.transports if transport.healthy and transport.rtt is not None]
+    return min(rtts) if rtts else None
+
+  def _release_session(self, session):
+    if session.transport in self.session_counts:
+      self.session_counts[session.transport] -= 1
+
+  async def close(self):
+    transports, self.transports = self.transports, []
+    self.session_counts = {}
+    if KurentoClientPool.pools.get(self.url) is self:
+      del KurentoClientPool.pools[self.url]
+    await asyncio.gather(*[transport.close() for transport in transports])
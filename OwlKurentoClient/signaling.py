@@ -0,0 +1,140 @@
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Session(object):
+  # One signaling connection, e.g. a browser's websocket
+  __slots__ = ("session_id", "handler", "name", "call", "pending_candidates", "touched_at")
+
+  def __init__(self, session_id, handler, touched_at):
+    self.session_id = session_id
+    # Whatever talks to the browser, the registry never looks inside
+    self.handler = handler
+    self.name = None
+    self.call = None
+    # ICE candidates received before the session's call has its media
+    self.pending_candidates = []
+    self.touched_at = touched_at
+
+  @property
+  def peer(self):
+    if self.call is None:
+      return None
+    return self.call.callee if self.call.caller is self else self.call.caller
+
+
+class Call(object):
+  __slots__ = ("call_id", "caller", "callee", "pipeline", "started_at")
+
+  def __init__(self, call_id, caller, callee, pipeline, started_at):
+    self.call_id = call_id
+    self.caller = caller
+    self.callee = callee
+    # Whatever holds the call's media, e.g. the one2one example's CallMediaPipeline
+    self.pipeline = pipeline
+    self.started_at = started_at
+
+
+# Signaling state of a one to one calling app, indexed so that every lookup is a
+# dict access: sessions by id, by registered name and by call id, with each
+# session linked to its call and through it to its peer. Sessions idle for longer
+# than `ttl` seconds are evicted by evict_stale(), oldest first, without looking at
+# the others.
+class SessionRegistry(object):
+
+  def __init__(self, ttl=None, clock=time.monotonic):
+    self.ttl = ttl
+    self.clock = clock
+    # Dict in the form {<session id>: Session}, least recently touched first
+    self.sessions = collections.OrderedDict()
+    # Dict in the form {"<name>": Session}
+    self.names = {}
+    # Dict in the form {<call id>: Call}
+    self.calls = {}
+
+  def __len__(self):
+    return len(self.sessions)
+
+  def open(self, session_id, handler):
+    session = Session(session_id, handler, self.clock())
+    self.sessions[session_id] = session
+    return session
+
+  def touch(self, session):
+    if session.session_id in self.sessions:
+      session.touched_at = self.clock()
+      self.sessions.move_to_end(session.session_id)
+
+  def register(self, session, name):
+    # Returns False when the name is taken or the session already has one
+    if not name or name in self.names or session.name is not None:
+      return False
+    session.name = name
+    self.names[name] = session
+    return True
+
+  def unregister(self, session):
+    if session.name is not None and self.names.get(session.name) is session:
+      del self.names[session.name]
+    session.name = None
+
+  def by_session_id(self, session_id):
+    return self.sessions.get(session_id)
+
+  def by_name(self, name):
+    return self.names.get(name)
+
+  def by_call_id(self, call_id):
+    return self.calls.get(call_id)
+
+  def start_call(self, call_id, caller, callee, pipeline=None):
+    if caller.call is not None or callee.call is not None:
+      raise ValueError("Both sessions must be free to start a call")
+    call = Call(call_id, caller, callee, pipeline, self.clock())
+    self.calls[call_id] = call
+    caller.call = call
+    callee.call = call
+    return call
+
+  def end_call(self, call):
+    # Unlinks both sessions, returns None when the call already ended
+    if call is None or self.calls.pop(call.call_id, None) is None:
+      return None
+    call.caller.call = None
+    call.callee.call = None
+    return call
+
+  def add_pending_candidate(self, session, candidate):
+    session.pending_candidates.append(candidate)
+
+  def take_pending_candidates(self, session):
+    candidates, session.pending_candidates = session.pending_candidates, []
+    return candidates
+
+  def close(self, session):
+    # Forgets the session and ends its call, which is returned for cleaning up.
+    # Closing a session twice is harmless
+    if self.sessions.pop(session.session_id, None) is None:
+      return None
+    if session.name is not None and self.names.get(session.name) is session:
+      del self.names[session.name]
+    session.pending_candidates = []
+    return self.end_call(session.call)
+
+  def evict_stale(self, now=None):
+    # Returns (session, ended call or None) for every evicted session
+    if self.ttl is None:
+      return []
+
+    expires_before = (self.clock() if now is None else now) - self.ttl
+    evicted = []
+    while self.sessions:
+      session = next(iter(self.sessions.values()))
+      if session.touched_at >= expires_before:
+        break
+      logger.info(f"Evicting signaling session {session.session_id} idle for over {self.ttl}s")
+      evicted.append((session, self.close(session)))
+    return evicted
@@ -0,0 +1,147 @@
+from OwlKurentoClient import media
+from OwlKurentoClient.transaction import NEW_REF_PREFIX
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TopologyException(Exception):
+  pass
+
+
+# Declarative description of the elements of a pipeline and how they are wired:
+#
+#   topology = Topology()
+#   topology.element("caller", media.WebRtcEndpoint)
+#   topology.element("callee", media.WebRtcEndpoint)
+#   topology.connect("caller", "callee")
+#
+#   objects = await topology.build(client)
+#   objects["pipeline"], objects["caller"], ...
+#
+# Building works out which operations depend on which and issues every operation
+# as soon as its dependencies are done, so setup takes as many round trips as the
+# graph is deep instead of one per operation.
+class Topology(object):
+  PIPELINE = "pipeline"
+
+  def __init__(self):
+    # Dict in the form {"<name>": (MediaElement subclass, args, (<dependency name>, ...))}
+    self.elements = {}
+    # List of (source name, sink name)
+    self.connections = []
+    # List of (name, operation, args)
+    self.invocations = []
+
+  def element(self, name, cls, **args):
+    self._add_element(name, cls, args, ())
+    return self
+
+  def hub_port(self, name, hub, **args):
+    self._check_name(hub)
+    self._add_element(name, media.HubPort, args, (hub,))
+    return self
+
+  def connect(self, source, sink):
+    self._check_name(source)
+    self._check_name(sink)
+    self.connections.append((source, sink))
+    return self
+
+  def invoke(self, name, operation, **args):
+    # Runs once the element exists and every connection touching it is made
+    self._check_name(name)
+    self.invocations.append((name, operation, args))
+    return self
+
+  def _add_element(self, name, cls, args, dependencies):
+    if name == self.PIPELINE or name in self.elements:
+      raise TopologyException(f"Element '{name}' is already defined")
+    self.elements[name] = (cls, args, dependencies)
+
+  def _check_name(self, name):
+    # Dependencies have to be declared first, which also keeps the graph acyclic
+    if name not in self.elements:
+      raise TopologyException(f"Unknown element '{name}'")
+
+  async def build(self, client, pipeline=None, transaction=False):
+    # With transaction=True every operation is queued into a single Kurento
+    # transaction, otherwise independent operations run concurrently
+    if not transaction:
+      return await self._build(client, pipeline)
+
+    objects = {}
+    try:
+      async with client.transaction():
+        objects = await self._build(client, pipeline)
+    except Exception:
+      # Kurento transactions are not atomic, release whatever did get created
+      created = [obj for name, obj in objects.items()
+                 if name != self.PIPELINE and not str(obj.id).startswith(NEW_REF_PREFIX)]
+      owned_pipeline = objects.get(self.PIPELINE) if pipeline is None else None
+      if owned_pipeline is not None and str(owned_pipeline.id).startswith(NEW_REF_PREFIX):
+        owned_pipeline = None
+      await self._rollback(owned_pipeline, created)
+      raise
+    return objects
+
+  async def _build(self, client, pipeline):
+    owns_pipeline = pipeline is None
+    if owns_pipeline:
+      pipeline = await client.create_pipeline()
+
+    objects = {self.PIPELINE: pipeline}
+    created = []
+    tasks = {}
+
+    async def _create(name):
+      cls, args, dependencies = self.elements[name]
+      dependency_objects = [await tasks[dependency] for dependency in dependencies]
+      obj = await cls.build(pipeline, *dependency_objects, **args)
+      objects[name] = obj
+      created.append(obj)
+      return obj
+
+    async def _connect(source, sink):
+      source_obj, sink_obj = await asyncio.gather(tasks[source], tasks[sink])
+      return await source_obj.connect(sink_obj)
+
+    async def _invoke(name, operation, args, dependencies):
+      obj = await tasks[name]
+      await asyncio.gather(*dependencies)
+      return await obj.invoke(operation, **args)
+
+    for name in self.elements:
+      tasks[name] = asyncio.ensure_future(_create(name))
+
+    all_tasks = list(tasks.values())
+    # Dict in the form {"<name>": [connect tasks touching that element]}
+    connect_tasks = {}
+    for source, sink in self.connections:
+      task = asyncio.ensure_future(_connect(source, sink))
+      connect_tasks.setdefault(source, []).append(task)
+      connect_tasks.setdefault(sink, []).append(task)
+      all_tasks.append(task)
+
+    for name, operation, args in self.invocations:
+      all_tasks.append(asyncio.ensure_future(_invoke(name, operation, args, connect_tasks.get(name, []))))
+
+    # Let everything in flight settle before deciding, so nothing created is lost track of
+    results = await asyncio.gather(*all_tasks, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+      logger.warning(f"Building topology failed, rolling back {len(created)} elements: {errors[0]}")
+      await self._rollback(pipeline if owns_pipeline else None, created)
+      raise errors[0]
+
+    return objects
+
+  async def _rollback(self, pipeline, created):
+    # Releasing the pipeline releases every element in it
+    targets = [pipeline] if pipeline is not None else created
+    results = await asyncio.gather(*[target.release() for target in targets], return_exceptions=True)
+    for result in results:
+      if isinstance(result, Exception):
+        logger.warning(f"Failed to release while rolling back: {result}")
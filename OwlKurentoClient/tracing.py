@@ -0,0 +1,131 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar("kurento_span", default=None)
+
+
+def current_span():
+  return _current_span.get()
+
+
+class Span(object):
+
+  def __init__(self, tracer, name, parent=None, attributes=None):
+    self.tracer = tracer
+    self.name = name
+    self.parent = parent
+    self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+    self.span_id = os.urandom(8).hex()
+    self.attributes = attributes or {}
+    # Wall clock for correlating with other systems, perf_counter for the duration
+    self.start_time = time.time()
+    self._started_at = time.perf_counter()
+    self.duration = None
+    self.error = None
+
+  def set_attribute(self, key, value):
+    self.attributes[key] = value
+
+  def end(self, error=None):
+    if self.duration is not None:
+      return
+    self.duration = time.perf_counter() - self._started_at
+    if error is not None:
+      self.error = f"{type(error).__name__}: {error}"
+    self.tracer.export(self)
+
+  def as_dict(self):
+    return {
+      "trace_id": self.trace_id,
+      "span_id": self.span_id,
+      "parent_id": self.parent.span_id if self.parent is not None else None,
+      "name": self.name,
+      "start_time": self.start_time,
+      "duration": self.duration,
+      "error": self.error,
+      "attributes": self.attributes
+    }
+
+
+# Minimal vendor neutral tracing. A signaling handler opens a span around the work
+# for one message, and every RPC sent while it is open, also from tasks started
+# inside it, is recorded by the transport as a child span:
+#
+#   tracer = Tracer(JsonLinesExporter("traces.jsonl"))
+#
+#   with tracer.span("incomingCallResponse", caller=name):
+#     pipeline = await client.create_pipeline()
+#     ...
+#
+# RPC spans are named like the metrics keys (invoke:processOffer, create:WebRtcEndpoint)
+# and carry the method, object type, request id and round trip to the media server.
+# A tracer without an exporter records nothing, so handlers can stay instrumented.
+class Tracer(object):
+
+  def __init__(self, exporter=None):
+    self.exporter = exporter
+
+  @contextlib.contextmanager
+  def span(self, name, **attributes):
+    if self.exporter is None:
+      yield None
+      return
+
+    span = Span(self, name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(span)
+    try:
+      yield span
+    except BaseException as e:
+      span.end(e)
+      raise
+    else:
+      span.end()
+    finally:
+      _current_span.reset(token)
+
+  def start_span(self, name, parent=None, **attributes):
+    # A span that is not made current, ended by calling end() on it
+    return Span(self, name, parent=parent, attributes=attributes)
+
+  def export(self, span):
+    if self.exporter is None:
+      return
+    try:
+      self.exporter.export(span)
+    except Exception as e:
+      logger.warning(f"Failed to export span {span.name}: {e}")
+
+
+class SpanExporter(object):
+  # Receives every finished span, adapt this to send them to a tracing backend
+
+  def export(self, span):
+    raise NotImplementedError()
+
+  def close(self):
+    pass
+
+
+class JsonLinesExporter(SpanExporter):
+  # Appends one JSON object per finished span to a local file
+
+  def __init__(self, path):
+    self.path = path
+    # Line buffered, a crash loses at most the span being written
+    self.file = open(path, "a", buffering=1)
+    self.lock = threading.Lock()
+
+  def export(self, span):
+    line = json.dumps(span.as_dict(), default=str)
+    with self.lock:
+      self.file.write(line + "\n")
+
+  def close(self):
+    self.file.close()
@@ -0,0 +1,164 @@
+from OwlKurentoClient.transport import KurentoTransportException
+
+import asyncio
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+_current_transaction = contextvars.ContextVar("kurento_transaction", default=None)
+
+# Kurento resolves ids of the form "newref:<operation id>" to the object created
+# by that operation earlier in the same transaction
+NEW_REF_PREFIX = "newref:"
+
+
+# Collects create/invoke/release calls made inside an `async with client.transaction():`
+# block and sends them as one JSON-RPC "transaction" request when the block exits.
+# Objects built inside the block carry a "newref:" placeholder id, usable by later
+# operations of the same transaction, that is replaced with the real id on commit.
+# Invocations return futures which resolve on commit:
+#
+#   async with client.transaction():
+#     webrtc = await media.WebRtcEndpoint.build(pipeline)
+#     answer = await webrtc.process_offer(offer)
+#   sdp_answer = await answer
+class Transaction(object):
+
+  def __init__(self, transport, timeout=None):
+    self.transport = transport
+    # Bounds the single request carrying the whole batch
+    self.timeout = timeout
+    self.operations = []
+    self.futures = []
+    # Dict in the form {"newref:<operation id>": MediaObject}
+    self.objects = {}
+    self.subscriptions = []
+    self.committed = False
+    self._token = None
+
+  @classmethod
+  def current(cls, transport=None):
+    transaction = _current_transaction.get()
+    if transaction is None or transaction.committed:
+      return None
+    if transport is not None and transaction.transport is not transport:
+      return None
+    return transaction
+
+  async def __aenter__(self):
+    self._token = _current_transaction.set(self)
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    _current_transaction.reset(self._token)
+    self._token = None
+    if exc_type is None:
+      await self.commit()
+    else:
+      self.rollback()
+
+  def _add(self, method, **params):
+    operation = {
+      "jsonrpc": "2.0",
+      "id": len(self.operations),
+      "method": method,
+      "params": params
+    }
+    future = asyncio.get_running_loop().create_future()
+    self.operations.append(operation)
+    self.futures.append(future)
+    return operation["id"], future
+
+  def bind(self, media_object):
+    self.objects[media_object.id] = media_object
+
+  # Individual operations accept a timeout for interface compatibility, only the
+  # transaction's own timeout applies since they all travel in one request
+  async def create(self, obj_type, timeout=None, **args):
+    operation_id, _ = self._add("create", type=obj_type, constructorParams=args)
+    return f"{NEW_REF_PREFIX}{operation_id}"
+
+  async def invoke(self, object_id, operation, timeout=None, **args):
+    _, future = self._add("invoke", object=object_id, operation=operation, operationParams=args)
+    return future
+
+  async def release(self, object_id, timeout=None):
+    _, future = self._add("release", object=object_id)
+    return future
+
+  async def subscribe(self, object_id, event_type, fn, timeout=None, **delivery_options):
+    # Subscriptions need a real object id, so they are issued right after the commit
+    future = asyncio.get_running_loop().create_future()
+    self.subscriptions.append((object_id, event_type, fn, delivery_options, future))
+    return future
+
+  async def unsubscribe(self, subscription_id, timeout=None):
+    return await self.transport.unsubscribe(subscription_id, timeout=timeout)
+
+  def is_subscribed(self, subscription_id):
+    return self.transport.is_subscribed(subscription_id)
+
+  def _resolve_ref(self, object_id):
+    media_object = self.objects.get(object_id)
+    return media_object.id if media_object is not None else object_id
+
+  async def commit(self):
+    self.committed = True
+    if self.operations:
+      try:
+        results = await self.transport.transaction(self.operations, timeout=self.timeout)
+      except BaseException as e:
+        self._fail(e)
+        raise
+
+      error = None
+      for index, (future, response) in enumerate(zip(self.futures, results or [])):
+        if "error" in response:
+          message = response["error"].get("message", "Unknown Error")
+          future.set_exception(KurentoTransportException(message, response))
+          error = error or future.exception()
+          continue
+
+        value = response["result"].get("value") if "result" in response else response.get("value")
+        ref = f"{NEW_REF_PREFIX}{index}"
+        if ref in self.objects:
+          media_object = self.objects[ref]
+          media_object.id = value
+          media_object.get_client().register(media_object)
+        future.set_result(value)
+
+      if len(results or []) < len(self.futures):
+        error = error or KurentoTransportException("Missing responses in transaction result", results)
+      if error is not None:
+        self._fail(error)
+        raise error
+
+    if self.subscriptions:
+      await asyncio.gather(*[self._subscribe(*subscription) for subscription in self.subscriptions])
+
+  async def _subscribe(self, object_id, event_type, fn, delivery_options, future):
+    try:
+      future.set_result(await self.transport.subscribe(self._resolve_ref(object_id), event_type, fn, **delivery_options))
+    except Exception as e:
+      future.set_exception(e)
+      raise
+
+  def rollback(self):
+    self.committed = True
+    self._fail(asyncio.CancelledError())
+
+  def _fail(self, error):
+    # Settles every outstanding future and marks the errors as retrieved, callers
+    # only see them if they actually await the result of an operation
+    for future in self.futures:
+      if not future.done():
+        if isinstance(error, asyncio.CancelledError):
+          future.cancel()
+        else:
+          future.set_exception(error)
+      if not future.cancelled():
+        future.exception()
+    for *_, future in self.subscriptions:
+      if not future.done():
+        future.cancel()
@@ -1,35 +1,152 @@
+from OwlKurentoClient.codec import default_codec
+from OwlKurentoClient.events import EventSubscriber
+from OwlKurentoClient.metrics import TransportMetrics
+from OwlKurentoClient import tracing
+
 import websockets
 
 import json
 import logging
 import asyncio
+import contextlib
+import contextvars
+import itertools
+import random
+import time
 
 logger = logging.getLogger(__name__)
 
+# Seconds a reconnect waits for the server to answer the session resume, when
+# neither keepalive_timeout nor timeout is set
+RESUME_TIMEOUT = 10
+
+# Absolute event loop time every RPC of the current context has to finish by
+_current_deadline = contextvars.ContextVar("kurento_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+  # Bounds every RPC made inside the block, including tasks it spawns, by one
+  # overall time budget. Nested deadlines can only shorten the outer one
+  expires_at = asyncio.get_running_loop().time() + seconds
+  outer = _current_deadline.get()
+  if outer is not None:
+    expires_at = min(expires_at, outer)
+
+  token = _current_deadline.set(expires_at)
+  try:
+    yield
+  finally:
+    _current_deadline.reset(token)
+
+
+def _background_task(coroutine):
+  # Tasks inherit the context they are created in. The transport's own work must
+  # not run under the deadline or tracing span of whoever happened to open it
+  return contextvars.Context().run(asyncio.ensure_future, coroutine)
+
+
+def _pipeline_id(object_id):
+  # Kurento ids the objects of a pipeline "<pipeline id>/<object id>"
+  if isinstance(object_id, str) and "/" in object_id:
+    return object_id.split("/", 1)[0]
+  return None
+
+
 class KurentoTransportException(Exception):
     def __init__(self, message, response={}):
       super(KurentoTransportException, self).__init__(message)
       self.response = response
 
     def __str__(self):
-      return "%s - %s" % (str(self.message), json.dumps(self.response))
+      if not self.response:
+        return str(self.args[0])
+      return "%s - %s" % (str(self.args[0]), json.dumps(self.response))
+
+
+class KurentoConnectionException(KurentoTransportException):
+  pass
+
+
+class KurentoTimeoutException(KurentoTransportException):
+    def __init__(self, message, request):
+      super(KurentoTimeoutException, self).__init__(message)
+      self.request = request
 
 
 class AsyncTransport(object):
 
   @classmethod
-  async def build(cls, url):
-    self = AsyncTransport()
+  async def build(cls, url, timeout=None, codec=None, reconnect_delay=0.5, max_reconnect_delay=30,
+                  max_reconnect_attempts=None, metrics=None, connect=None, keepalive_interval=None,
+                  keepalive_timeout=None, max_missed_pings=3, rtt_alpha=0.125):
+    self = cls()
     self.url = url
-    self.ws = await websockets.client.connect(url)
-    self.worker = asyncio.create_task(self._response_worker())
+    # connect(url) -> connection with async send/recv/close, a websocket by default
+    self.connect = connect or websockets.client.connect
+    self.codec = codec or default_codec()
+    # Default upper bound in seconds for each RPC, None waits forever
+    self.timeout = timeout
+    # Optional metrics.TransportMetrics, None keeps instrumentation off entirely
+    self.metrics = metrics
+    self.ws = await self.connect(url)
+    self.reconnect_delay = reconnect_delay
+    self.max_reconnect_delay = max_reconnect_delay
+    self.max_reconnect_attempts = max_reconnect_attempts
+    # Cleared while the connection is being re-established, requests wait on it
+    self.connected = asyncio.Event()
+    self.connected.set()
+    self.closing = False
+    # Why requests fail once the transport is closed
+    self.close_reason = "Transport closed"
     self.responses = []
     self.current_id = 0
     self.session_id = None
+    # Dict in the form {<request_id>: asyncio.Future}, entries live only while a request is in flight
     self.pending_responses = {}
+    # Dict in the form {(<object_id>, <event_type>): {<subscription_id>: EventSubscriber}}
     self.subscriptions = {}
+    # Dict in the form {<subscription_id>: (<object_id>, <event_type>)}
+    self.subscription_keys = {}
+    # Dict in the form {<object_id>: {(<object_id>, <event_type>), ...}}, the keys of self.subscriptions by object
+    self.object_subscriptions = {}
+    # Dict in the form {<pipeline_id>: {<object_id>, ...}}, objects of a pipeline found in self.object_subscriptions
+    self.pipeline_objects = {}
+    # Dict in the form {(<object_id>, <event_type>): asyncio.Task resolving to the server subscription id}
+    self.server_subscriptions = {}
+    self.subscription_ids = itertools.count(1)
+    # Seconds between keepalive pings, None sends none. A ping not answered within
+    # keepalive_timeout seconds, the interval by default, is missed
+    self.keepalive_interval = keepalive_interval
+    self.keepalive_timeout = keepalive_timeout or keepalive_interval
+    self.max_missed_pings = max_missed_pings
+    self.rtt_alpha = rtt_alpha
+    # Smoothed ping round trip in seconds, None until the first pong
+    self.rtt = None
+    self.missed_pings = 0
+    # False once max_missed_pings pings in a row went unanswered, until one is answered
+    self.healthy = True
+    self.worker = _background_task(self._response_worker())
+    self.keepalive_task = _background_task(self._keepalive_worker()) if keepalive_interval else None
     return self
 
+  @property
+  def in_flight(self):
+    return len(self.pending_responses)
+
+  @property
+  def available(self):
+    # Whether requests sent now can expect an answer
+    return self.connected.is_set() and not self.closing and self.healthy
+
+  async def close(self):
+    self.closing = True
+    self.worker.cancel()
+    if self.keepalive_task is not None:
+      self.keepalive_task.cancel()
+    self._fail_pending(KurentoConnectionException("Transport closed"))
+    await self.ws.close()
+
   def _next_id(self):
     self.current_id += 1
     return self.current_id
@@ -40,54 +157,304 @@ class AsyncTransport(object):
 
       try:
         message = await self.ws.recv()
-        logger.debug(f"<== {message}")
-        response_obj = json.loads(message)
-        
-        if "id" in response_obj:
-            self.pending_responses.update({response_obj["id"]: response_obj})
+      except Exception as e:
+        if self.closing:
+          return
+        logger.warning(f"Lost connection to {self.url}: {e}")
+        try:
+          await self._reconnect()
+        except Exception as e:
+          # Out of reconnect attempts, the transport is closed for good
+          self.close_reason = f"Gave up reconnecting to {self.url}: {e}"
+          self._fail_pending(KurentoConnectionException(self.close_reason))
+          return
+        continue
+
+      try:
+        blocked = self._handle_message(message)
+        if blocked:
+          # Some subscriber queue is full and asked the read loop to wait
+          await asyncio.gather(*blocked)
+      except Exception as e:
+        logger.critical(f"There was an error parsing the response {e}")
+
+  def _handle_message(self, message):
+    # Lazy formatting, several KB of SDP are not worth a string copy with debug logging off
+    logger.debug("<== %s", message)
+    # In-process connections pass messages without encoding them, there are no bytes to count
+    if self.metrics is not None and isinstance(message, (str, bytes)):
+      self.metrics.bytes_received += len(message)
+    return self._dispatch(self.codec.decode(message))
+
+  def _dispatch(self, response_obj):
+    if "id" in response_obj:
+      self._resolve_response(response_obj)
+
+    if "method" in response_obj and response_obj["method"] == "onEvent":
+      return self._execute_subscriber_callback(response_obj)
+    return None
+
+  async def _keepalive_worker(self):
+    while not self.closing:
+      await asyncio.sleep(self.keepalive_interval)
+      # Nothing to learn while reconnecting, requests are held back anyway
+      if self.connected.is_set() and not self.closing:
+        await self._keepalive()
+
+  async def _keepalive(self):
+    # The interval, in milliseconds, tells the server when to expect the next ping
+    started_at = time.perf_counter()
+    try:
+      await self.ping(interval=int(self.keepalive_interval * 1000), timeout=self.keepalive_timeout)
+    except KurentoTransportException as e:
+      self._record_missed_ping(e)
+    else:
+      self._record_rtt(time.perf_counter() - started_at)
 
-        if "method" in response_obj and response_obj["method"] == "onEvent":
-          self._execute_subscriber_callback(response_obj)
+  def _record_rtt(self, seconds):
+    if self.rtt is None:
+      self.rtt = seconds
+    else:
+      self.rtt += self.rtt_alpha * (seconds - self.rtt)
+    self.missed_pings = 0
+    if not self.healthy:
+      logger.info(f"{self.url} answers pings again, rtt {self.rtt * 1000:.1f}ms")
+      self.healthy = True
+
+  def _record_missed_ping(self, error):
+    self.missed_pings += 1
+    if not self.healthy or self.missed_pings < self.max_missed_pings:
+      return
+
+    # A half open socket would leave requests hanging until their timeout, they
+    # fail now and dropping the socket makes the response worker reconnect
+    logger.warning(f"{self.url} missed {self.missed_pings} pings in a row, marking it unhealthy: {error}")
+    self.healthy = False
+    self._fail_pending(KurentoConnectionException(f"{self.url} stopped answering pings"))
+    asyncio.ensure_future(self.ws.close())
 
+  async def _reconnect(self):
+    # Requests already sent may or may not have been executed, replaying a create
+    # could duplicate objects, so they fail. Requests made from now on wait for the
+    # connection to come back and are sent afterwards
+    self.connected.clear()
+    self._fail_pending(KurentoConnectionException(f"Connection to {self.url} lost"))
 
+    delay = self.reconnect_delay
+    attempt = 0
+    while True:
+      attempt += 1
+      ws = None
+      try:
+        ws = self.ws = await self.connect(self.url)
+        # A socket can open, through a proxy say, without the server ever answering
+        resumed = await asyncio.wait_for(self._resume_session(), self._resume_timeout())
+        break
       except Exception as e:
-        logger.critical(f"There was an error parsing the response {e}")
+        if ws is not None:
+          await self._discard(ws)
+        if isinstance(e, asyncio.TimeoutError):
+          e = KurentoConnectionException(f"No answer to the session resume from {self.url}")
+        if self.max_reconnect_attempts is not None and attempt >= self.max_reconnect_attempts:
+          logger.critical(f"Giving up reconnecting to {self.url} after {attempt} attempts: {e}")
+          self.closing = True
+          # Wake up waiting requests so they fail instead of hanging
+          self.connected.set()
+          raise
+        logger.warning(f"Reconnect attempt {attempt} to {self.url} failed, retrying in {delay:.1f}s: {e}")
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(delay * 2, self.max_reconnect_delay)
+
+    logger.info(f"Reconnected to {self.url}, session {'resumed' if resumed else 'lost'}")
+    self.connected.set()
+    if not resumed and self.server_subscriptions:
+      _background_task(self._resubscribe())
+
+  def _resume_timeout(self):
+    return self.keepalive_timeout or self.timeout or RESUME_TIMEOUT
+
+  async def _discard(self, ws):
+    # Closes the socket of a failed reconnect attempt so attempts don't leak connections
+    try:
+      await asyncio.wait_for(ws.close(), self._resume_timeout())
+    except Exception as e:
+      logger.debug(f"Failed to close the socket of a reconnect attempt: {e}")
+
+  async def _resume_session(self):
+    # Sends the Kurento "connect" request straight over the new socket, the response
+    # worker is the one reconnecting so it can't be relied on to read the answer
+    if self.session_id is None:
+      return False
+
+    request = self._build_request("connect")
+    await self.ws.send(self.codec.encode(request))
+    while True:
+      response_obj = self.codec.decode(await self.ws.recv())
+      if response_obj.get("id") == request["id"]:
+        break
+      blocked = self._dispatch(response_obj)
+      if blocked:
+        await asyncio.gather(*blocked)
+
+    if "error" in response_obj:
+      # The server no longer knows the session, everything tied to it is gone
+      logger.warning(f"Could not resume session {self.session_id}: {response_obj['error']}")
+      self.session_id = None
+      return False
+
+    self._capture_session(response_obj)
+    return True
+
+  async def _resubscribe(self):
+    # A new session starts without subscriptions, ask for them again. Local
+    # subscription ids stay the same, only the server side ids change
+    for key in list(self.server_subscriptions):
+      object_id, event_type = key
+      task = asyncio.ensure_future(self._rpc("subscribe", object=object_id, type=event_type))
+      self.server_subscriptions[key] = task
+      try:
+        await asyncio.shield(task)
+      except Exception as e:
+        logger.warning(f"Failed to re-register {event_type} subscription on {object_id}: {e}")
+
+  def _fail_pending(self, error):
+    pending, self.pending_responses = self.pending_responses, {}
+    for future in pending.values():
+      if not future.done():
+        future.set_exception(error)
 
   def _execute_subscriber_callback(self, response_obj):
     # Ensure that both nested values exist
     try:
-      event_type = response_obj["params"]["value"]["type"]
-      data = response_obj["params"]["value"]["data"]
+      value = response_obj["params"]["value"]
+      event_type = value["type"]
+      data = value["data"]
     except KeyError as e:
-      return 
+      return None
     else:
-      if event_type in self.subscriptions:
-        callback = self.subscriptions[event_type]
-        callback(data)
+      object_id = value.get("object") or data.get("source")
+      if self.metrics is not None:
+        self.metrics.record_event(event_type)
+      subscribers = self.subscriptions.get((object_id, event_type))
+      if not subscribers:
+        return None
+
+      # Copy so callbacks can unsubscribe themselves while being iterated
+      blocked = []
+      for subscription_id, subscriber in list(subscribers.items()):
+        try:
+          result = subscriber.deliver(data)
+        except Exception as e:
+          logger.exception(f"Subscriber {subscription_id} failed handling {event_type} from {object_id}")
+        else:
+          if result is not None:
+            blocked.append(result)
+      return blocked
 
-  async def _get_specific_response(self, id):
-      while True:
-          await asyncio.sleep(0)
+  def _capture_session(self, response_obj):
+    session_id = response_obj.get("result", {}).get("sessionId")
+    if session_id:
+      self.session_id = session_id
 
-          if id in self.pending_responses:
-              return self.pending_responses[id]
+  def _resolve_response(self, response_obj):
+    self._capture_session(response_obj)
 
-  async def _rpc(self, rpc_type, **args):
+    # Responses for requests nobody is waiting on anymore are dropped
+    future = self.pending_responses.pop(response_obj["id"], None)
+    if future is not None and not future.done():
+      future.set_result(response_obj)
+
+  def _build_request(self, rpc_type, **args):
     if self.session_id:
       args["sessionId"] = self.session_id
 
-    request = {
+    return {
       "jsonrpc": "2.0",
       "id": self._next_id(),
       "method": rpc_type,
       "params": args
     }
-    json_message = json.dumps(request)
 
-    await self.ws.send(json_message)
-    logger.debug(f"==> {json_message}")
+  def _effective_timeout(self, timeout):
+    timeout = self.timeout if timeout is None else timeout
+    expires_at = _current_deadline.get()
+    if expires_at is None:
+      return timeout
+
+    remaining = expires_at - asyncio.get_running_loop().time()
+    return remaining if timeout is None else min(timeout, remaining)
+
+  async def _rpc(self, rpc_type, timeout=None, **args):
+    metrics = self.metrics
+    parent_span = tracing.current_span()
+    if metrics is None and parent_span is None:
+      return await self._request(rpc_type, timeout, args)
+
+    key = TransportMetrics.operation_key(rpc_type, args)
+    span = None
+    if parent_span is not None:
+      span = parent_span.tracer.start_span(key, parent=parent_span, method=rpc_type, **_span_attributes(rpc_type, args))
+
+    error = None
+    started_at = time.perf_counter()
+    if metrics is not None:
+      metrics.request_started()
+    try:
+      return await self._request(rpc_type, timeout, args, span)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      if metrics is not None:
+        metrics.request_finished(key, time.perf_counter() - started_at, error)
+      if span is not None:
+        span.end(error)
+
+  async def _request(self, rpc_type, timeout, args, span=None):
+    loop = asyncio.get_running_loop()
+    timeout = self._effective_timeout(timeout)
+    request = self._build_request(rpc_type, **args)
+    if timeout is not None and timeout <= 0:
+      raise KurentoTimeoutException(f"Deadline exceeded before sending {rpc_type}", request)
+
+    if not self.connected.is_set():
+      # Waiting for a reconnect counts against the timeout too
+      started_at = loop.time()
+      try:
+        await asyncio.wait_for(self.connected.wait(), timeout)
+      except asyncio.TimeoutError:
+        raise KurentoTimeoutException(f"Timed out waiting for connection to send {rpc_type}", request) from None
+      if timeout is not None:
+        timeout -= loop.time() - started_at
+    if self.closing:
+      raise KurentoConnectionException(self.close_reason)
+
+    json_message = self.codec.encode(request)
+    if self.metrics is not None and isinstance(json_message, (str, bytes)):
+      self.metrics.bytes_sent += len(json_message)
 
-    resp = await self._get_specific_response(request["id"])
+    # Register before sending so a fast response can never be missed
+    future = loop.create_future()
+    self.pending_responses[request["id"]] = future
+    try:
+      try:
+        await self.ws.send(json_message)
+      except Exception as e:
+        # The response worker notices the dead socket on its own and reconnects
+        raise KurentoConnectionException(f"Failed to send request: {e}", request) from e
+      logger.debug("==> %s", json_message)
+      if span is None:
+        resp = await asyncio.wait_for(future, timeout)
+      else:
+        span.set_attribute("request_id", request["id"])
+        sent_at = time.perf_counter()
+        resp = await asyncio.wait_for(future, timeout)
+        # Server processing plus network, Kurento does not report the two apart
+        span.set_attribute("round_trip", time.perf_counter() - sent_at)
+    except asyncio.TimeoutError:
+      raise KurentoTimeoutException(f"{rpc_type} request {request['id']} timed out after {timeout:.3f}s", request) from None
+    finally:
+      self.pending_responses.pop(request["id"], None)
     
     if 'error' in resp:
       raise KurentoTransportException(resp['error']['message'] if 'message' in resp['error'] else 'Unknown Error', resp)
@@ -96,20 +463,138 @@ class AsyncTransport(object):
     else:
       return None # just to be explicit
 
-  async def create(self, obj_type, **args):
-    return await self._rpc("create", type=obj_type, constructorParams=args)
+  async def create(self, obj_type, timeout=None, **args):
+    return await self._rpc("create", timeout=timeout, type=obj_type, constructorParams=args)
 
-  async def invoke(self, object_id, operation, **args):
-    return await self._rpc("invoke", object=object_id, operation=operation, operationParams=args)
+  async def invoke(self, object_id, operation, timeout=None, **args):
+    return await self._rpc("invoke", timeout=timeout, object=object_id, operation=operation, operationParams=args)
 
-  async def subscribe(self, object_id, event_type, fn):
-    subscription_id = await self._rpc("subscribe", object=object_id, type=event_type)
-    self.subscriptions[event_type] = fn
+  async def subscribe(self, object_id, event_type, fn, timeout=None, **delivery_options):
+    # Subscriptions are multiplexed locally: the server is only asked once per
+    # (object, event type) and every event is fanned out to all local subscribers.
+    # delivery_options are passed on to EventSubscriber
+    key = (object_id, event_type)
+    subscription_id = next(self.subscription_ids)
+    if self.metrics is not None:
+      delivery_options.setdefault("lag", self.metrics.event_lag)
+    if key not in self.subscriptions:
+      self.subscriptions[key] = {}
+      self._index_subscriptions(key)
+    self.subscriptions[key][subscription_id] = EventSubscriber(fn, **delivery_options)
+    self.subscription_keys[subscription_id] = key
+
+    try:
+      await self._server_subscription(key, timeout)
+    except BaseException:
+      self._remove_subscriber(subscription_id)
+      raise
     return subscription_id
 
-  async def unsubscribe(self, subscription_id):
-    del self.subscriptions[subscription_id]
-    return await self._rpc("unsubscribe", subscription=subscription_id)
+  async def unsubscribe(self, subscription_id, timeout=None):
+    # Stop local delivery first so no event sneaks in while the server is asked
+    key = self._remove_subscriber(subscription_id)
+    if key is None:
+      raise KurentoTransportException(f"Unknown subscription {subscription_id}")
+    if key in self.subscriptions or key not in self.server_subscriptions:
+      return None
+
+    object_id, _ = key
+    server_subscription_id = await asyncio.shield(self.server_subscriptions.pop(key))
+    return await self._rpc("unsubscribe", timeout=timeout, object=object_id, subscription=server_subscription_id)
+
+  def is_subscribed(self, subscription_id):
+    # False once unsubscribed, or dropped along with a released object
+    return subscription_id in self.subscription_keys
+
+  async def _server_subscription(self, key, timeout=None):
+    task = self.server_subscriptions.get(key)
+    if task is None:
+      object_id, event_type = key
+      task = asyncio.ensure_future(self._rpc("subscribe", timeout=timeout, object=object_id, type=event_type))
+      self.server_subscriptions[key] = task
+
+    try:
+      return await asyncio.shield(task)
+    except Exception:
+      if self.server_subscriptions.get(key) is task:
+        del self.server_subscriptions[key]
+      raise
+
+  def forget_object(self, object_id, children=False):
+    # Drops the local subscriptions to a released object, with children=True also
+    # those to the objects of a released pipeline. The server forgot them along
+    # with the object, so nothing is sent. Returns the dropped subscription ids
+    object_ids = [object_id]
+    if children:
+      object_ids.extend(self.pipeline_objects.get(object_id, ()))
+
+    dropped = []
+    for forgotten_id in object_ids:
+      for key in self.object_subscriptions.get(forgotten_id, ()):
+        dropped.extend(self.subscriptions[key])
+        self.server_subscriptions.pop(key, None)
+    for subscription_id in dropped:
+      self._remove_subscriber(subscription_id)
+    return dropped
+
+  def _remove_subscriber(self, subscription_id):
+    key = self.subscription_keys.pop(subscription_id, None)
+    if key is None:
+      return None
+
+    subscribers = self.subscriptions[key]
+    subscribers.pop(subscription_id).close()
+    if not subscribers:
+      del self.subscriptions[key]
+      self._unindex_subscriptions(key)
+    return key
+
+  def _index_subscriptions(self, key):
+    # Keeps forget_object from scanning every subscription of the connection
+    object_id = key[0]
+    self.object_subscriptions.setdefault(object_id, set()).add(key)
+    pipeline_id = _pipeline_id(object_id)
+    if pipeline_id is not None:
+      self.pipeline_objects.setdefault(pipeline_id, set()).add(object_id)
+
+  def _unindex_subscriptions(self, key):
+    object_id = key[0]
+    keys = self.object_subscriptions[object_id]
+    keys.discard(key)
+    if keys:
+      return
+    del self.object_subscriptions[object_id]
+    pipeline_id = _pipeline_id(object_id)
+    if pipeline_id is not None:
+      objects = self.pipeline_objects[pipeline_id]
+      objects.discard(object_id)
+      if not objects:
+        del self.pipeline_objects[pipeline_id]
+
+  async def ping(self, interval=None, timeout=None):
+    # Kurento keepalive, the server answers "pong"
+    args = {} if interval is None else {"interval": interval}
+    return await self._rpc("ping", timeout=timeout, **args)
+
+  async def release(self, object_id, timeout=None):
+    return await self._rpc("release", timeout=timeout, object=object_id)
+
+  async def transaction(self, operations, timeout=None):
+    return await self._rpc("transaction", timeout=timeout, operations=operations)
+
 
-  async def release(self, object_id):
-    return await self._rpc("release", object=object_id)
+def _span_attributes(rpc_type, args):
+  attributes = {}
+  if "type" in args:
+    attributes["object_type" if rpc_type == "create" else "event"] = args["type"]
+  if "object" in args:
+    object_id = args["object"]
+    attributes["object"] = object_id
+    # Kurento ids end in "_kurento.<Type>" or "_<Type>" for well known objects
+    if isinstance(object_id, str) and "_" in object_id:
+      attributes["object_type"] = object_id.rsplit("_", 1)[-1].replace("kurento.", "")
+  if "operation" in args:
+    attributes["operation"] = args["operation"]
+  if "operations" in args:
+    attributes["operations"] = len(args["operations"])
+  return attributes
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Compares two result files of benchmarks/run.py and exits with status 1 when a
+# figure got worse by more than the threshold:
+#
+#   python benchmarks/compare.py before.json after.json --threshold 0.1
+
+import argparse
+import json
+import sys
+
+# Figures describing the run rather than measuring it
+SETTINGS = {"calls", "rounds", "events", "subscribers", "requests_per_round"}
+
+
+def flatten(results, prefix=""):
+    figures = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            figures.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key not in SETTINGS:
+            figures[name] = value
+    return figures
+
+
+def higher_is_better(name):
+    return name.endswith("per_second")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    base_figures = flatten(base["results"])
+    new_figures = flatten(new["results"])
+    regressions = 0
+    print(f"{'figure':<55} {'base':>14} {'new':>14} {'change':>8}")
+    for name in sorted(base_figures.keys() & new_figures.keys()):
+        before, after = base_figures[name], new_figures[name]
+        change = (after - before) / abs(before) if before else 0.0
+        worse = -change if higher_is_better(name) else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<55} {before:>14.6g} {after:>14.6g} {change:>+8.1%}{flag}")
+
+    print(f"\n{regressions} regressions over {args.threshold:.0%} "
+          f"({base.get('commit') or 'unknown'} -> {new.get('commit') or 'unknown'})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# Benchmarks the client against a local mock media server and saves the results
+# as JSON, compare two runs with benchmarks/compare.py:
+#
+#   python benchmarks/run.py -o before.json
+#   ... change things ...
+#   python benchmarks/run.py -o after.json
+#   python benchmarks/compare.py before.json after.json
+#
+# CPU figures include the mock server, which runs in the same process.
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from OwlKurentoClient import KurentoClient, media
+from OwlKurentoClient.broadcast import Broadcast
+from OwlKurentoClient.mock_server import MockKurentoServer
+from OwlKurentoClient.pipeline_pool import PipelinePool
+from OwlKurentoClient.transport import AsyncTransport
+
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def latency_summary(samples):
+    return {
+        "p50": percentile(samples, 0.5),
+        "p99": percentile(samples, 0.99),
+        "max": max(samples) if samples else None
+    }
+
+
+async def timed(coroutine, samples):
+    started_at = time.perf_counter()
+    await coroutine
+    samples.append(time.perf_counter() - started_at)
+
+
+async def rpc_throughput(server, requests, concurrency_levels):
+    # The same invoke over and over, `concurrency` of them in flight at any time
+    client = await KurentoClient.build(server.url)
+    pipeline = await client.create_pipeline()
+    endpoint = await media.WebRtcEndpoint.build(pipeline)
+
+    results = {}
+    for concurrency in concurrency_levels:
+        samples = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await timed(endpoint.invoke("getUri"), samples)
+
+        cpu_started_at = time.process_time()
+        started_at = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(requests)])
+        elapsed = time.perf_counter() - started_at
+        cpu = time.process_time() - cpu_started_at
+
+        results[str(concurrency)] = dict(
+            latency_summary(samples),
+            rpc_per_second=requests / elapsed,
+            cpu_per_rpc=cpu / requests)
+
+    await client.close()
+    return results
+
+
+async def memory_growth(server, rounds, requests_per_round):
+    # Memory should level off after the first rounds, steady growth means something
+    # is kept per request
+    transport = await AsyncTransport.build(server.url)
+    client = await KurentoClient.build(server.url, transport=transport)
+    pipeline = await client.create_pipeline()
+    endpoint = await media.WebRtcEndpoint.build(pipeline)
+
+    tracemalloc.start()
+    sizes = []
+    for _ in range(rounds):
+        await asyncio.gather(*[endpoint.invoke("getUri") for _ in range(requests_per_round)])
+        gc.collect()
+        sizes.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+
+    result = {
+        "rounds": rounds,
+        "requests_per_round": requests_per_round,
+        "first_round_bytes": sizes[0],
+        "last_round_bytes": sizes[-1],
+        # Averaged over the second half, once caches and free lists have warmed up
+        "growth_per_round_bytes": (sizes[-1] - sizes[len(sizes) // 2]) / max(1, rounds - 1 - len(sizes) // 2),
+        "pending_responses": len(transport.pending_responses)
+    }
+    await client.close()
+    return result
+
+
+async def event_fanout(server, subscribers, events):
+    # One server subscription fanned out to `subscribers` local callbacks
+    client = await KurentoClient.build(server.url)
+    pipeline = await client.create_pipeline()
+    endpoint = await media.WebRtcEndpoint.build(pipeline)
+
+    expected = subscribers * events
+    delivered = 0
+    done = asyncio.Event()
+
+    def on_event(event, endpoint):
+        nonlocal delivered
+        delivered += 1
+        if delivered == expected:
+            done.set()
+
+    for _ in range(subscribers):
+        await endpoint.on_add_ice_candidate_event(on_event)
+
+    started_at = time.perf_counter()
+    for index in range(events):
+        server.kurento.emit(endpoint.id, "OnIceCandidate", {"candidate": {"candidate": str(index)}})
+        if index % 100 == 0:
+            # Let the socket drain instead of queueing every frame at once
+            await asyncio.sleep(0)
+    await asyncio.wait_for(done.wait(), 60)
+    elapsed = time.perf_counter() - started_at
+
+    await client.close()
+    return {
+        "subscribers": subscribers,
+        "events": events,
+        "deliveries_per_second": expected / elapsed,
+        "events_per_second": events / elapsed
+    }
+
+
+async def call_setup(server, calls):
+    # The one2one example's call pipeline built on demand, then a whole call set up
+    # from a warm pool the way its handler does: acquiring a pipeline, subscribing
+    # to candidates, answering both offers and starting to gather candidates
+    from examples.one2one.handlers import CALL_TOPOLOGY, CallMediaPipeline
+
+    client = await KurentoClient.build(server.url)
+    cold = []
+    for _ in range(calls):
+        await timed(CALL_TOPOLOGY.build(client, transaction=True), cold)
+
+    pool = await PipelinePool.build(client, CALL_TOPOLOGY, low=calls, high=calls, idle_ttl=None)
+    while len(pool) < calls:
+        await asyncio.sleep(0.01)
+
+    acquire = []
+    setup = []
+    pipelines = []
+    for _ in range(calls):
+        started_at = time.perf_counter()
+        pipeline = await CallMediaPipeline.build(pool, client)
+        acquire.append(time.perf_counter() - started_at)
+        await pipeline.subscribe_ice_candidates(lambda events, endpoint: None, lambda events, endpoint: None)
+        await pipeline.generate_sdp_answer_for_callee("offer")
+        await pipeline.callee_endpoint.gather_candidates()
+        await pipeline.generate_sdp_answer_for_caller("offer")
+        await pipeline.caller_endpoint.gather_candidates()
+        setup.append(time.perf_counter() - started_at)
+        pipelines.append(pipeline)
+
+    await asyncio.gather(*[pipeline.release() for pipeline in pipelines])
+    await pool.close()
+    await client.close()
+    return {
+        "calls": calls,
+        "topology_build": latency_summary(cold),
+        "pool_acquire": latency_summary(acquire),
+        "call_setup_from_pool": latency_summary(setup)
+    }
+
+
+async def broadcast_join(server, viewers, batch_size):
+    # An audience joining at once, then single viewers joining the full broadcast
+    client = await KurentoClient.build(server.url)
+    broadcast = await Broadcast.build(client, batch_size=batch_size)
+    await broadcast.set_presenter("offer", lambda events, endpoint: None)
+
+    crowd = []
+    started_at = time.perf_counter()
+    await asyncio.gather(*[timed(broadcast.join("offer", lambda events, endpoint: None), crowd)
+        for _ in range(viewers)])
+    elapsed = time.perf_counter() - started_at
+
+    late = []
+    for _ in range(20):
+        await timed(broadcast.join("offer", lambda events, endpoint: None), late)
+
+    shards = len(broadcast.shards)
+    await broadcast.close()
+    await client.close()
+    return {
+        "viewers": viewers,
+        "shards": shards,
+        "joins_per_second": viewers / elapsed,
+        "crowd_join": latency_summary(crowd),
+        "late_join": latency_summary(late)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    server = await MockKurentoServer.build(port=0, latency=args.latency, jitter=args.jitter)
+    results = {}
+    try:
+        results["rpc_throughput"] = await rpc_throughput(server, args.requests, args.concurrency)
+        results["memory_growth"] = await memory_growth(server, args.rounds, args.requests // 10 or 1)
+        results["event_fanout"] = await event_fanout(server, args.subscribers, args.events)
+        results["call_setup"] = await call_setup(server, args.calls)
+        results["broadcast_join"] = await broadcast_join(server, args.viewers, args.batch_size)
+    finally:
+        await server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Kurento client against a mock media server")
+    parser.add_argument("-o", "--output", help="file to write the JSON results to, stdout otherwise")
+    parser.add_argument("--requests", type=int, default=5000, help="RPCs per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--rounds", type=int, default=20, help="rounds of the memory growth run")
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=20)
+    parser.add_argument("--viewers", type=int, default=2000, help="audience joining the broadcast at once")
+    parser.add_argument("--batch-size", type=int, default=50, help="broadcast viewers set up per transaction")
+    parser.add_argument("--latency", type=float, default=0, help="seconds the mock server adds to each response")
+    parser.add_argument("--jitter", type=float, default=0)
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "options": vars(args),
+        "results": asyncio.run(run(args))
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
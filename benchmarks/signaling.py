@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Calls per second through the one2one example app for a growing number of
+# signaling workers, with a mock media server behind it:
+#
+#   python benchmarks/signaling.py --workers 1 2 4 -o signaling.json
+#
+# Every call is a pair of websocket clients registering, calling, answering and
+# hanging up. Connections are spread over the workers by the kernel, so most
+# calls go through the session directory once there are several workers. Load
+# comes from several processes so the clients do not become the bottleneck, the
+# mock media server is a single process and may become one at high worker counts.
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from benchmarks.run import git_commit, latency_summary
+
+import websockets
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import platform
+import signal
+import socket
+import subprocess
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SDP_OFFER = "v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\nm=video 9 UDP/TLS/RTP/SAVPF 96\r\n"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def start(command, **env):
+    # In its own process group so that forked workers are stopped with it
+    return subprocess.Popen(
+        command, cwd=ROOT, env=dict(os.environ, **env), start_new_session=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+async def expect(ws, id):
+    # Skips candidates and anything else until the message we wait for
+    while True:
+        message = json.loads(await ws.recv())
+        if message.get("id") == id:
+            return message
+
+
+async def register(ws, name):
+    await ws.send(json.dumps({"id": "register", "name": name}))
+    response = await expect(ws, "registerResponse")
+    if response["response"] != "accepted":
+        raise RuntimeError(f"{name} was not registered")
+
+
+async def one_call(url, caller_name, callee_name):
+    # Returns the seconds from the call to both peers having their SDP answer
+    async with websockets.client.connect(url) as caller, websockets.client.connect(url) as callee:
+        await asyncio.gather(register(caller, caller_name), register(callee, callee_name))
+
+        started_at = time.perf_counter()
+        await caller.send(json.dumps({"id": "call", "from": caller_name, "to": callee_name, "sdpOffer": SDP_OFFER}))
+        await expect(callee, "incomingCall")
+        await callee.send(json.dumps(
+            {"id": "incomingCallResponse", "from": caller_name, "callResponse": "accept", "sdpOffer": SDP_OFFER}))
+        await asyncio.gather(expect(callee, "startCommunication"), expect(caller, "callResponse"))
+        elapsed = time.perf_counter() - started_at
+
+        await caller.send(json.dumps({"id": "stop"}))
+        await expect(callee, "stopCommunication")
+        return elapsed
+
+
+async def call_load(url, prefix, calls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        async with semaphore:
+            try:
+                samples.append(await one_call(url, f"{prefix}-caller-{i}", f"{prefix}-callee-{i}"))
+            except Exception:
+                failures += 1
+
+    await asyncio.gather(*[one(i) for i in range(calls)])
+    return samples, failures
+
+
+def load_process(arguments):
+    return asyncio.run(call_load(*arguments))
+
+
+def measure(kms_url, workers, args):
+    port = free_port()
+    app = start([sys.executable, "examples/app.py", "--port", str(port), "--workers", str(workers)],
+        KMS_URL=kms_url, SSL_CERT=os.devnull + ".missing")
+    try:
+        wait_for_port(port)
+        url = f"ws://127.0.0.1:{port}/one2onews"
+
+        # A round to fill the pipeline pools and open media server connections
+        with multiprocessing.Pool(args.clients) as pool:
+            pool.map(load_process, [(url, f"warmup-{n}", args.concurrency, args.concurrency)
+                for n in range(args.clients)])
+
+            started_at = time.perf_counter()
+            results = pool.map(load_process, [(url, f"load-{n}", args.calls // args.clients, args.concurrency)
+                for n in range(args.clients)])
+            elapsed = time.perf_counter() - started_at
+    finally:
+        stop(app)
+
+    samples = [sample for process_samples, _ in results for sample in process_samples]
+    return dict(
+        latency_summary(samples),
+        calls=len(samples),
+        failures=sum(failures for _, failures in results),
+        calls_per_second=len(samples) / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calls/s of the one2one example by number of workers")
+    parser.add_argument("-o", "--output", help="file to write the JSON results to, stdout otherwise")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--calls", type=int, default=2000, help="calls per worker count")
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--concurrency", type=int, default=25, help="calls in flight per load process")
+    parser.add_argument("--latency", type=float, default=0, help="seconds the mock server adds to each response")
+    args = parser.parse_args()
+
+    kms_port = free_port()
+    kms = start([sys.executable, "-m", "OwlKurentoClient.mock_server", "--port", str(kms_port),
+        "--latency", str(args.latency)])
+    try:
+        wait_for_port(kms_port)
+        kms_url = f"ws://127.0.0.1:{kms_port}/kurento"
+        results = {str(workers): measure(kms_url, workers, args) for workers in args.workers}
+    finally:
+        stop(kms)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "timestamp": time.time(),
+        "options": vars(args),
+        "results": {"signaling_scaling": results}
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
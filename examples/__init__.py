@@ -5,6 +5,15 @@ base_path = os.path.dirname(__file__)
 
 sys.path.append(os.path.abspath(os.path.join(base_path, '..')))
 
+from OwlKurentoClient.tracing import Tracer, JsonLinesExporter
+
+# Media server the examples talk to
+KMS_URL = os.environ.get("KMS_URL", "ws://localhost:8888/kurento")
+
+# Set KURENTO_TRACE_FILE to record a span per signaling message, with the media
+# server round trips it caused as children
+tracer = Tracer(JsonLinesExporter(os.environ["KURENTO_TRACE_FILE"]) if os.environ.get("KURENTO_TRACE_FILE") else None)
+
 def render_view(handler, name):
     with open("%s/views/%s.html" % (base_path, name), "r") as f:
         handler.finish(f.read())
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
+import argparse
 import os
 import sys
 import logging
+import multiprocessing
 import signal
 import ssl
+import tempfile
 import tornado.ioloop
 import tornado.web
 import tornado.httpserver
+import tornado.netutil
+import tornado.process
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -17,34 +22,101 @@ logging.getLogger("examples.one2one.handlers").setLevel(logging.DEBUG)
 
 import examples.helloworld.handlers
 import examples.one2one.handlers
-from examples import render_view
+from examples import KMS_URL, render_view
+from examples.directory import DirectoryClient, run_directory
+from OwlKurentoClient import KurentoClientPool
+from OwlKurentoClient.ownership import Reaper
 
 
 class IndexHandler(tornado.web.RequestHandler):
     def get(self):
         render_view(self, "index")
 
-application = tornado.web.Application([
-    (r"/", IndexHandler),
-    (r"/helloworld", examples.helloworld.handlers.HelloWorldHandler),
-    (r"/helloworldws", examples.helloworld.handlers.HelloWorldWSHandler),
-    (r"/one2one", examples.one2one.handlers.One2OneHandler),
-    (r"/one2onews", examples.one2one.handlers.One2OneWSHandler),
-    (r'/static/(.*)', tornado.web.StaticFileHandler,
-        {'path': os.path.join(os.path.dirname(__file__), "static")}),
-], debug=True)
+async def start_reaper():
+    # Releases pipelines whose sessions went away without managing to release them
+    pool = await KurentoClientPool.get(KMS_URL)
+    client = await pool.client()
+    await Reaper.build(client)
 
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 8090))
+def make_application(debug=True):
+    return tornado.web.Application([
+        (r"/", IndexHandler),
+        (r"/helloworld", examples.helloworld.handlers.HelloWorldHandler),
+        (r"/helloworldws", examples.helloworld.handlers.HelloWorldWSHandler),
+        (r"/one2one", examples.one2one.handlers.One2OneHandler),
+        (r"/one2onews", examples.one2one.handlers.One2OneWSHandler),
+        (r'/static/(.*)', tornado.web.StaticFileHandler,
+            {'path': os.path.join(os.path.dirname(__file__), "static")}),
+    ], debug=debug,
+        # Pongs keep idle signaling sessions from being evicted
+        websocket_ping_interval=60)
+
+def make_ssl_context():
+    # HTTPS is only served when the certificate is there
+    cert = os.environ.get("SSL_CERT", "/home/chance/git/moltres/defaultCertificate.pem")
+    if not os.path.exists(cert):
+        print("No certificate at %s, not serving HTTPS" % cert)
+        return None
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(cert)
+    return ssl_context
+
+async def join_directory(path, worker_id):
+    handler = examples.one2one.handlers.One2OneWSHandler
+    handler.directory = await DirectoryClient.build(path, worker_id, handler.on_directory_message)
+
+def run_single(port):
+    application = make_application()
     application.listen(port)
     print("Webserver now listening on port %d" % port)
 
     # Add HTTPS Server
-    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    ssl_context.load_cert_chain("/home/chance/git/moltres/defaultCertificate.pem")
-    https_server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_context)
-    https_server.listen(443)
+    ssl_context = make_ssl_context()
+    if ssl_context is not None:
+        https_server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_context)
+        https_server.listen(443)
 
-    ioloop = tornado.ioloop.IOLoop.instance()
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop.add_callback(start_reaper)
     signal.signal(signal.SIGINT, lambda sig, frame: ioloop.stop())
     ioloop.start()
+
+def run_workers(port, workers):
+    # The sockets are bound before forking and shared by every worker, each worker
+    # then has its own IOLoop, media server connections and pipeline pool. Call
+    # state stays with the worker whose browser it belongs to, the session
+    # directory process routes what has to go to another worker.
+    sockets = tornado.netutil.bind_sockets(port)
+    ssl_context = make_ssl_context()
+    https_sockets = tornado.netutil.bind_sockets(443) if ssl_context is not None else []
+
+    directory_path = os.path.join(tempfile.gettempdir(), "one2one-directory-%d.sock" % os.getpid())
+    directory = multiprocessing.Process(target=run_directory, args=(directory_path,), daemon=True)
+    directory.start()
+    print("Webserver now listening on port %d with %d workers" % (port, workers))
+
+    # Returns in the workers only, the master restarts workers that die
+    worker_id = tornado.process.fork_processes(workers)
+
+    # Autoreload does not work with several processes
+    application = make_application(debug=False)
+    tornado.httpserver.HTTPServer(application).add_sockets(sockets)
+    if https_sockets:
+        tornado.httpserver.HTTPServer(application, ssl_options=ssl_context).add_sockets(https_sockets)
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    ioloop.add_callback(join_directory, directory_path, worker_id)
+    ioloop.add_callback(start_reaper)
+    ioloop.start()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kurento examples")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8090)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", 1)),
+        help="signaling processes, 0 for one per core")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_single(args.port)
+    else:
+        run_workers(args.port, args.workers or multiprocessing.cpu_count())
@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# SDP offers travel through the directory, keep well above their size
+LINE_LIMIT = 1024 * 1024
+
+
+def _write(writer, message):
+    writer.write((json.dumps(message) + "\n").encode())
+
+
+# Session directory shared by the signaling workers of app.py, served over a unix
+# socket by the master process. It knows which worker holds each registered name
+# and routes messages for a name to that worker. Every line is a JSON object:
+#
+#   {"op": "hello", "worker": <worker id>, "id": 1}        -> {"id": 1, "result": true}
+#   {"op": "register", "name": "alice", "id": 2}           -> {"id": 2, "result": <registered>}
+#   {"op": "unregister", "name": "alice"}
+#   {"op": "send", "to": "bob", "message": {...}, "id": 3} -> {"id": 3, "result": <delivered>}
+#
+# and the worker holding "bob" receives {"op": "deliver", "to": "bob", "message": {...}}.
+# Requests without an id get no answer. Names of a worker that goes away are dropped.
+class DirectoryServer(object):
+
+    @classmethod
+    async def build(cls, path):
+        self = cls()
+        self.path = path
+        # Dict in the form {"<name>": <worker id>}
+        self.names = {}
+        # Dict in the form {<worker id>: StreamWriter}
+        self.workers = {}
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._serve, path, limit=LINE_LIMIT)
+        return self
+
+    async def _serve(self, reader, writer):
+        worker_id = None
+        try:
+            async for line in reader:
+                message = json.loads(line)
+                op = message.get("op")
+                if op == "hello":
+                    worker_id = message["worker"]
+                    self.workers[worker_id] = writer
+                    result = True
+                elif op == "register":
+                    owner = self.names.setdefault(message["name"], worker_id)
+                    result = owner == worker_id
+                elif op == "unregister":
+                    if self.names.get(message["name"]) == worker_id:
+                        del self.names[message["name"]]
+                    result = None
+                elif op == "send":
+                    target = self.workers.get(self.names.get(message["to"]))
+                    if target is not None:
+                        _write(target, {"op": "deliver", "to": message["to"], "message": message["message"]})
+                    result = target is not None
+                else:
+                    logger.warning(f"Unknown directory operation: {op}")
+                    result = None
+
+                if "id" in message:
+                    _write(writer, {"id": message["id"], "result": result})
+                    await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Dropping directory connection of worker {worker_id}: {e}")
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.names = {name: owner for name, owner in self.names.items() if owner != worker_id}
+            writer.close()
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def run_directory(path):
+    # Entry point of the directory process
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(DirectoryServer.build(path))
+    loop.run_forever()
+
+
+# A worker's connection to the DirectoryServer. Messages routed to names held by
+# this worker are passed to on_deliver(name, message).
+class DirectoryClient(object):
+
+    @classmethod
+    async def build(cls, path, worker_id, on_deliver, connect_timeout=10):
+        self = cls()
+        self.worker_id = worker_id
+        self.on_deliver = on_deliver
+        self.ids = itertools.count(1)
+        # Dict in the form {<request id>: Future}
+        self.pending = {}
+
+        # The directory process may still be starting
+        deadline = asyncio.get_running_loop().time() + connect_timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if asyncio.get_running_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+        self.read_task = asyncio.ensure_future(self._read())
+        await self._request("hello", worker=worker_id)
+        return self
+
+    async def _read(self):
+        try:
+            async for line in self.reader:
+                message = json.loads(line)
+                if message.get("op") == "deliver":
+                    try:
+                        self.on_deliver(message["to"], message["message"])
+                    except Exception:
+                        logger.exception(f"Failed to deliver a message to {message['to']}")
+                else:
+                    future = self.pending.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message["result"])
+        finally:
+            logger.error(f"Worker {self.worker_id} lost the session directory")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Session directory connection lost"))
+            self.pending = {}
+
+    async def _request(self, op, **params):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        _write(self.writer, dict(params, op=op, id=request_id))
+        await self.writer.drain()
+        return await future
+
+    async def register(self, name):
+        # False when another worker holds the name
+        return await self._request("register", name=name)
+
+    def unregister(self, name):
+        _write(self.writer, {"op": "unregister", "name": name})
+
+    async def send(self, name, message):
+        # False when no worker holds the name
+        return await self._request("send", to=name, message=message)
+
+    def post(self, name, message):
+        # Like send(), without waiting to know whether anyone got it
+        _write(self.writer, {"op": "send", "to": name, "message": message})
+
+    def close(self):
+        self.read_task.cancel()
+        self.writer.close()
+
+
+class RemoteHandler(object):
+    # Stands in for the websocket handler of a session held by another worker, what
+    # is written to it reaches that session's browser through the directory
+
+    def __init__(self, directory, name, **attributes):
+        self.directory = directory
+        self.name = name
+        for key, value in attributes.items():
+            setattr(self, key, value)
+
+    def post(self, message):
+        # Sends a message to the worker holding the session
+        self.directory.post(self.name, message)
+
+    def write_message(self, message):
+        self.post({"op": "relay", "message": message})
+
+    def close(self):
+        pass
@@ -1,8 +1,8 @@
 import tornado.web
 import tornado.websocket
-from examples import render_view
+from examples import KMS_URL, render_view, tracer
 from OwlKurentoClient import (
-    KurentoClient,
+    KurentoClientPool,
     media
 )
 
@@ -22,14 +22,20 @@ class HelloWorldWSHandler(tornado.websocket.WebSocketHandler):
     async def open(self):
         logger.info("WebSocket opened!")
         self.session_id = uuid.uuid4()
-        self.url = "ws://localhost:8888/kurento"
-        self.client = await KurentoClient.build(self.url)
+        self.url = KMS_URL
+        # All handlers share a few pooled connections to the media server
+        pool = await KurentoClientPool.get(self.url)
+        self.client = await pool.client()
 
     async def on_message(self, message):
 
         json_message = json.loads(message)
         id = json_message.get("id")
 
+        with tracer.span(id or "unknown", session_id=str(self.session_id)):
+            await self._handle_message(id, json_message)
+
+    async def _handle_message(self, id, json_message):
         if id == "PROCESS_SDP_OFFER":
             await self._handle_process_sdp_offer(json_message)
         elif id == "ADD_ICE_CANDIDATE":
@@ -39,10 +45,11 @@ class HelloWorldWSHandler(tornado.websocket.WebSocketHandler):
         elif id == "ERROR":
             await self._handle_error(json_message)
         else:
-            logger.info(f"Found invalid message, skipping. Message: ({message}) ")
+            logger.info(f"Found invalid message, skipping. Message: ({json_message}) ")
 
     def on_close(self):
         logger.info("WebSocket closed!")
+        asyncio.ensure_future(self.client.close())
 
     async def _handle_process_sdp_offer(self, json_message):
 
@@ -1,10 +1,14 @@
 import tornado.web
 import tornado.websocket
-from examples import render_view
+from examples import KMS_URL, render_view, tracer
+from examples.directory import RemoteHandler
 from OwlKurentoClient import (
-    KurentoClient,
+    KurentoClientPool,
     media
 )
+from OwlKurentoClient.pipeline_pool import PipelinePool
+from OwlKurentoClient.signaling import SessionRegistry
+from OwlKurentoClient.topology import Topology
 
 import asyncio
 import json
@@ -19,32 +23,46 @@ class One2OneHandler(tornado.web.RequestHandler):
     def get(self):
         render_view(self, "one2one")
 
+# Seconds without any message or pong before a session is dropped
+SESSION_TTL = 2 * 60 * 60
+
 class One2OneWSHandler(tornado.websocket.WebSocketHandler):
 
-    # Dict in the form { "<name>": {"handler": handler} }
-    users = {}
+    # Every open session, indexed by session id, registered name and call id
+    registry = SessionRegistry(ttl=SESSION_TTL)
 
-    # Dict in the form of {"<session_id>": [candidates]}
-    pending_candidates = {}
+    # Task resolving to the PipelinePool shared by all calls, created by the first call
+    pipeline_pool_task = None
 
-    # Dict in the form {"<call_id>": CallMediaPipeline}
-    pipelines = {}
+    # DirectoryClient when app.py runs several workers. Sessions held by other
+    # workers then show up in the registry with a RemoteHandler, registered under
+    # their name for as long as a call with them is being set up or going on
+    directory = None
 
     async def open(self):
         logger.debug("WebSocket opened!")
         self.session_id = uuid.uuid4()
-        self.url = "ws://localhost:8888/kurento"
-        self.client = await KurentoClient.build(self.url)
+        self.session = One2OneWSHandler.registry.open(self.session_id, self)
+        self._evict_stale_sessions()
+        self.url = KMS_URL
+        # All handlers share a few pooled connections to the media server
+        pool = await KurentoClientPool.get(self.url)
+        self.client = await pool.client()
 
     async def on_message(self, json_message):
 
         message = json.loads(json_message)
         id = message.get("id")
+        self._touch()
+
+        with tracer.span(id or "unknown", session_id=str(self.session_id)):
+            await self._handle_message(id, message)
 
+    async def _handle_message(self, id, message):
         if id == "register":
-            self._handle_register(message)
+            await self._handle_register(message)
         elif id == "call":
-            self._handle_call(message)
+            await self._handle_call(message)
         elif id == "incomingCallResponse":
             await self._handle_incoming_call_response(message)
         elif id == "onIceCandidate":
@@ -54,25 +72,50 @@ class One2OneWSHandler(tornado.websocket.WebSocketHandler):
         else:
             logger.warn(f"Found invalid message, skipping. Message: ({message}) ")
 
+    def on_pong(self, data):
+        self._touch()
+
+    def _touch(self):
+        One2OneWSHandler.registry.touch(self.session)
+        # A stand in for a peer on another worker lasts as long as our side of the call
+        peer = self.session.peer
+        if peer is not None and isinstance(peer.handler, RemoteHandler):
+            One2OneWSHandler.registry.touch(peer)
+
     def on_close(self):
         logger.info("WebSocket closed!")
-        name, _ = self._get_user_by_session_id(self.session_id)
-        if (name):
-            logger.debug(f"removing {name} from user registry")
-            del One2OneWSHandler.users[name]
-        
-        if "session_id" in One2OneWSHandler.pending_candidates:
-            del One2OneWSHandler.pending_candidates[session_id]
-
-    def _handle_register(self, message):
+        if self.session.name:
+            logger.debug(f"removing {self.session.name} from user registry")
+            if One2OneWSHandler.directory is not None:
+                One2OneWSHandler.directory.unregister(self.session.name)
+        call = One2OneWSHandler.registry.close(self.session)
+        asyncio.ensure_future(self._close(call))
+
+    async def _close(self, call):
+        # A browser going away ends its call just like a stop message, the client
+        # then releases anything else it still owns
+        try:
+            await self._end_call(call, self.session)
+        finally:
+            await self.client.close()
+
+    def _evict_stale_sessions(self):
+        # Sessions whose socket died without a close, found a few at a time
+        for session, call in One2OneWSHandler.registry.evict_stale():
+            asyncio.ensure_future(One2OneWSHandler._end_call(call, session))
+            session.handler.close()
+
+    async def _handle_register(self, message):
         name = message.get("name")
+        registry = One2OneWSHandler.registry
+        directory = One2OneWSHandler.directory
 
-        if (name and name not in One2OneWSHandler.users):
-            user = { name: {"handler": self} }
+        # Names are unique across workers, the directory has the last word
+        if registry.register(self.session, name) and (directory is None or await directory.register(name)):
             logger.debug(f"adding {name} to user registry")
-            One2OneWSHandler.users.update(user)
             result = "accepted"
         else:
+            registry.unregister(self.session)
             result = "rejected" 
 
         response = {
@@ -81,20 +124,27 @@ class One2OneWSHandler(tornado.websocket.WebSocketHandler):
         }
         self.write_message(json.dumps(response))
 
-    def _handle_call(self, message):
+    async def _handle_call(self, message):
         call_to = message.get("to")
         call_from = message.get("from")
+        sdp_offer = message.get("sdpOffer")
+        callee = One2OneWSHandler.registry.by_name(call_to)
+        directory = One2OneWSHandler.directory
 
-        if call_to in One2OneWSHandler.users:
-            self.sdp_offer = message.get("sdpOffer")
+        if callee is not None and not isinstance(callee.handler, RemoteHandler):
+            self.sdp_offer = sdp_offer
             self.calling_to = call_to
 
-            callee_handler = One2OneWSHandler.users.get(call_to).get("handler")
             response = {
                 "id": "incomingCall",
                 "from": call_from
             }
-            callee_handler.write_message(json.dumps(response))
+            callee.handler.write_message(json.dumps(response))
+        elif directory is not None and await directory.send(
+                call_to, {"op": "incomingCall", "from": call_from, "sdpOffer": sdp_offer}):
+            # The callee's worker builds the call and asks for our candidates once it has
+            self.sdp_offer = sdp_offer
+            self.calling_to = call_to
         else:
             response = {
                 "id": "callResponse",
@@ -105,30 +155,45 @@ class One2OneWSHandler(tornado.websocket.WebSocketHandler):
     async def _handle_incoming_call_response(self, message):
         call_response = message.get("callResponse")
         call_from = message.get("from")
-        caller = One2OneWSHandler.users.get(call_from)
-        caller_handler = One2OneWSHandler.users.get(call_from).get("handler")
-        call_to = caller_handler.calling_to
-        callee_handler = One2OneWSHandler.users.get(call_to).get("handler")
+        caller = One2OneWSHandler.registry.by_name(call_from)
+        callee = self.session
+        if caller is None or getattr(caller.handler, "calling_to", None) != callee.name:
+            logger.warning(f"Ignoring response to a call from {call_from} that is not waiting for {callee.name}")
+            return
+        caller_handler = caller.handler
+        callee_handler = self
 
         if call_response == "accept":
-            logger.debug(f"accepted call from {call_from} to {call_to}")
-
-            call_id = uuid.uuid4()
-            caller_handler.call_id = call_id
-            callee_handler.call_id = call_id
+            logger.debug(f"accepted call from {call_from} to {callee.name}")
 
-            pipeline = await CallMediaPipeline.build(self.client)
-            pipeline.caller_id = caller_handler.session_id
-            pipeline.callee_id = callee_handler.session_id
+            # The pipeline is released with the callee's client should the call not be stopped
+            pipeline = await CallMediaPipeline.build(await self._get_pipeline_pool(), self.client)
+            logger.debug(f"acquired media pipeline")
 
-            logger.debug(f"created media pipeline")
-
-            await pipeline.callee_endpoint.on_add_ice_candidate_event(
+            # Linking the sessions and taking what they queued happens in one go, so
+            # every candidate either was queued or finds the call
+            call_id = uuid.uuid4()
+            try:
+                One2OneWSHandler.registry.start_call(call_id, caller, callee, pipeline)
+            except ValueError:
+                logger.warning(f"{call_from} or {callee.name} is already in a call")
+                await pipeline.release()
+                return
+
+            if isinstance(caller_handler, RemoteHandler):
+                caller_handler.post({"op": "callStarted", "peer": callee.name, "callId": str(call_id)})
+
+            # Endpoints hold candidates back until their SDP exchange is done, so
+            # everything queued for the two peers can be handed over right away
+            await pipeline.caller_endpoint.add_ice_candidates(
+                One2OneWSHandler.registry.take_pending_candidates(caller))
+            await pipeline.callee_endpoint.add_ice_candidates(
+                One2OneWSHandler.registry.take_pending_candidates(callee))
+
+            await pipeline.subscribe_ice_candidates(
+                self._create_on_ice_candidate_callback(caller_handler),
                 self._create_on_ice_candidate_callback(callee_handler)
             )
-            await pipeline.caller_endpoint.on_add_ice_candidate_event(
-                self._create_on_ice_candidate_callback(caller_handler)
-            )
             logger.debug("subscribed to iceCandidate events")
 
             callee_sdp_offer = message.get("sdpOffer")
@@ -152,110 +217,180 @@ class One2OneWSHandler(tornado.websocket.WebSocketHandler):
             caller_handler.write_message(json.dumps(call_response))
             await pipeline.caller_endpoint.gather_candidates()
 
-
-            # Transmit all pending ice candidates
-            if One2OneWSHandler.pending_candidates:
-                for session_id, candidates in One2OneWSHandler.pending_candidates.items():
-                    if session_id == pipeline.caller_id:
-                        for candidate in candidates:
-                            await pipeline.caller_endpoint.add_ice_candidate(candidate)
-                    else:
-                        for candidate in candidates:
-                            await pipeline.callee_endpoint.add_ice_candidate(candidate)
-
-            # Add pipeline to registry so that it can be referenced later
-            One2OneWSHandler.pipelines[call_id] = pipeline
+            # Recording is not needed to start the call, so it happens last
+            await pipeline.start_recording(f"file:///etc/kurento/videos/one2one-{call_id}.webm")
         else:
             response = {
                 "id": "callResponse",
                 "response": "rejected"
             }
             caller_handler.write_message(json.dumps(response))
+            if isinstance(caller_handler, RemoteHandler):
+                One2OneWSHandler.registry.close(caller)
 
     async def _handle_on_ice_candidate(self, message):
         candidate = message["candidate"]
+        call = self.session.call
 
         # If we haven't created a pipeline yet, add candidates to a queue to be sorted later
-        if not hasattr(self, "call_id"):
-            if self.session_id not in One2OneWSHandler.pending_candidates:
-                # create first entry
-                One2OneWSHandler.pending_candidates.update({self.session_id: [candidate]})
-            else:
-                # add new entries
-                One2OneWSHandler.pending_candidates[self.session_id].append(candidate)
-
-        # # Otherwise send them directly to the right endpoint
+        if call is None:
+            One2OneWSHandler.registry.add_pending_candidate(self.session, candidate)
+
+        # The media lives on the worker of the peer
+        elif call.pipeline is None:
+            call_candidates = {"op": "candidates", "from": self.session.name, "candidates": [candidate]}
+            self.session.peer.handler.post(call_candidates)
+
+        # Otherwise send them directly to the right endpoint
+        elif call.caller is self.session:
+            await call.pipeline.caller_endpoint.add_ice_candidate(candidate)
         else:
-            pipeline = One2OneWSHandler.pipelines.get(self.call_id)
-            if self.session_id == pipeline.caller_id:
-                await pipeline.caller_endpoint.add_ice_candidate(candidate)
-            else:
-                await pipeline.callee_endpoint.add_ice_candidate(candidate)
+            await call.pipeline.callee_endpoint.add_ice_candidate(candidate)
 
     async def _handle_stop(self, message):
-        if hasattr(self, "call_id") and One2OneWSHandler.pipelines.get(self.call_id):
-            logger.debug(f"releasing pipeline!")
-            await One2OneWSHandler.pipelines[self.call_id].release()
-
-            # Tell other caller to hangup
-            for _, value in One2OneWSHandler.users.items():
-                handler = value.get("handler")
-                if (hasattr(handler, "call_id") 
-                    and handler.call_id in One2OneWSHandler.pipelines
-                    and handler.session_id is not self.session_id):
+        await self._end_call(One2OneWSHandler.registry.end_call(self.session.call), self.session)
 
-                    name, value = self._get_user_by_session_id(handler.session_id)
-                    logger.debug(f"telling user: {name} to hang up")
-                    handler.write_message(json.dumps({"id": "stopCommunication"}))
+    @classmethod
+    async def _end_call(cls, call, ended_by):
+        # call is what the registry returned when ending it, None if there was none
+        if call is None:
+            return
+
+        peer = call.callee if call.caller is ended_by else call.caller
+        if isinstance(peer.handler, RemoteHandler):
+            # The peer's worker tells its browser to hang up and ends its side of the call
+            peer.handler.post({"op": "stop"})
+            cls.registry.close(peer)
+        else:
+            # Tell the other peer to hang up
+            logger.debug(f"telling user: {peer.name} to hang up")
+            try:
+                peer.handler.write_message(json.dumps({"id": "stopCommunication"}))
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+        # Only the worker of the callee holds the media
+        if call.pipeline is not None:
+            logger.debug(f"releasing pipeline!")
+            await call.pipeline.release()
 
-            del One2OneWSHandler.pipelines[self.call_id]
+    @classmethod
+    def on_directory_message(cls, name, message):
+        # Messages from other workers for the session registered as `name` here
+        session = cls.registry.by_name(name)
+        if session is None or isinstance(session.handler, RemoteHandler):
+            logger.debug(f"dropping {message.get('op')} message for {name}, who left")
+            return
+        cls.registry.touch(session)
+
+        op = message.get("op")
+        if op == "relay":
+            session.handler.write_message(message["message"])
+        elif op == "incomingCall":
+            # What the callee's response needs from the caller lives with its stand in
+            caller_name = message["from"]
+            cls._open_remote_session(caller_name, calling_to=name, sdp_offer=message["sdpOffer"])
+            session.handler.write_message(json.dumps({"id": "incomingCall", "from": caller_name}))
+        elif op == "callStarted":
+            # The callee's worker holds the call's media, our candidates go there
+            callee = cls._open_remote_session(message["peer"])
+            try:
+                cls.registry.start_call(message["callId"], session, callee)
+            except ValueError:
+                logger.warning(f"{name} or {callee.name} is already in a call")
+                return
+            candidates = cls.registry.take_pending_candidates(session)
+            if candidates:
+                callee.handler.post({"op": "candidates", "from": name, "candidates": candidates})
+        elif op == "candidates":
+            remote = cls.registry.by_name(message["from"])
+            call = remote.call if remote is not None else None
+            if call is None or call.pipeline is None:
+                return
+            endpoint = call.pipeline.caller_endpoint if call.caller is remote else call.pipeline.callee_endpoint
+            asyncio.ensure_future(endpoint.add_ice_candidates(message["candidates"]))
+        elif op == "stop":
+            remote = session.peer
+            call = cls.registry.end_call(session.call)
+            if remote is not None:
+                cls.registry.close(remote)
+                asyncio.ensure_future(cls._end_call(call, remote))
+        else:
+            logger.warning(f"Unknown message from another worker: {message}")
 
-    def _get_user_by_session_id(self, session_id):
-        for name, data in One2OneWSHandler.users.items():
-            if data.get("handler").session_id == session_id:
-                return (name, data)
-        return (None, None)
+    @classmethod
+    def _open_remote_session(cls, name, **attributes):
+        session = cls.registry.by_name(name)
+        if session is None:
+            handler = RemoteHandler(cls.directory, name)
+            session = cls.registry.open(f"remote:{name}", handler)
+            cls.registry.register(session, name)
+        for key, value in attributes.items():
+            setattr(session.handler, key, value)
+        return session
+
+    async def _get_pipeline_pool(self):
+        if One2OneWSHandler.pipeline_pool_task is None:
+            One2OneWSHandler.pipeline_pool_task = asyncio.ensure_future(self._build_pipeline_pool())
+        return await asyncio.shield(One2OneWSHandler.pipeline_pool_task)
+
+    async def _build_pipeline_pool(self):
+        # Pre-built pipelines outlive the handler that triggered them, so they get their own client
+        pool = await KurentoClientPool.get(self.url)
+        client = await pool.client()
+        return await PipelinePool.build(client, CALL_TOPOLOGY, low=2, high=5, idle_ttl=300)
 
     def _create_on_ice_candidate_callback(self, handler):
 
-        def _on_event(event, *args, **kwargs):
-            candidate = event["candidate"]
+        # Candidates gathered close together reach the browser in one message
+        def _on_events(events, *args, **kwargs):
             message = {
-                "id": "iceCandidate",
-                "candidate": candidate
+                "id": "iceCandidates",
+                "candidates": [event["candidate"] for event in events]
             }
             handler.write_message(json.dumps(message))
-        return _on_event
+        return _on_events
+
+# Caller and callee see each other, and both are mixed into a composite. The recorder
+# is added per call since its uri is part of the call
+CALL_TOPOLOGY = (Topology()
+    .element("caller_endpoint", media.WebRtcEndpoint)
+    .element("callee_endpoint", media.WebRtcEndpoint)
+    .element("composite", media.Composite)
+    .hub_port("hub_in_port1", "composite")
+    .hub_port("hub_in_port2", "composite")
+    .hub_port("hub_out_port", "composite")
+    .connect("caller_endpoint", "callee_endpoint")
+    .connect("callee_endpoint", "caller_endpoint")
+    .connect("caller_endpoint", "hub_in_port1")
+    .connect("callee_endpoint", "hub_in_port2"))
 
 class CallMediaPipeline(object):
 
     @classmethod
-    async def build(cls, client):
+    async def build(cls, pipeline_pool, owner):
         self = CallMediaPipeline()
-        self.pipeline = await client.create_pipeline()
-        self.caller_endpoint = await media.WebRtcEndpoint.build(self.pipeline)
-        self.callee_endpoint = await media.WebRtcEndpoint.build(self.pipeline)
+        self.subscriptions = []
 
-        await self.caller_endpoint.connect(self.callee_endpoint)
-        await self.callee_endpoint.connect(self.caller_endpoint)
+        # Pipelines are built ahead of time, only the per call parts happen here
+        objects = await pipeline_pool.acquire(owner=owner)
+        for name, obj in objects.items():
+            setattr(self, name, obj)
 
-        # adding composite recording
-        self.composite = await media.Composite.build(self.pipeline)
-        self.recorder = await media.RecorderEndpoint.build(
-            self.pipeline, uri="file:///etc/kurento/videos/one2one.webm")
-
-        self.hub_in_port1 = await media.HubPort.build(self.pipeline, self.composite)
-        self.hub_in_port2 = await media.HubPort.build(self.pipeline, self.composite)
-        self.hub_out_port = await media.HubPort.build(self.pipeline, self.composite)
+        return self
 
-        await self.caller_endpoint.connect(self.hub_in_port1)
-        await self.callee_endpoint.connect(self.hub_in_port2)
+    async def subscribe_ice_candidates(self, caller_fn, callee_fn):
+        subscription_ids = await asyncio.gather(
+            self.caller_endpoint.on_ice_candidates_event(caller_fn),
+            self.callee_endpoint.on_ice_candidates_event(callee_fn))
+        self.subscriptions.extend(zip((self.caller_endpoint, self.callee_endpoint), subscription_ids))
 
-        await self.hub_out_port.connect(self.recorder)
-        await self.recorder.record()
+    async def start_recording(self, uri):
+        async with self.pipeline.get_client().transaction():
+            self.recorder = await media.RecorderEndpoint.build(self.pipeline, uri=uri)
+            await self.hub_out_port.connect(self.recorder)
+            await self.recorder.record()
 
-        return self
-        
     async def generate_sdp_answer_for_caller(self, sdp_offer):
         return await self.caller_endpoint.process_offer(sdp_offer)
 
@@ -263,4 +398,8 @@ class CallMediaPipeline(object):
         return await self.callee_endpoint.process_offer(sdp_offer)
 
     async def release(self):
+        # The pipeline lives on the pool's shared client, drop our subscriptions from it too
+        await asyncio.gather(
+            *[endpoint.unsubscribe(subscription_id) for endpoint, subscription_id in self.subscriptions],
+            return_exceptions=True)
         return await self.pipeline.release()
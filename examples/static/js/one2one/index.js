@@ -136,6 +136,14 @@ ws.onmessage = function(message) {
 				return console.error('Error adding candidate: ' + error);
 		});
 		break;
+	case 'iceCandidates':
+		parsedMessage.candidates.forEach(function(candidate) {
+			webRtcPeer.addIceCandidate(candidate, function(error) {
+				if (error)
+					return console.error('Error adding candidate: ' + error);
+			});
+		});
+		break;
 	default:
 		console.error('Unrecognized message', parsedMessage);
 	}
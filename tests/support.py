@@ -0,0 +1,47 @@
+from OwlKurentoClient import KurentoClient
+from OwlKurentoClient.loopback import LoopbackTransport
+from OwlKurentoClient.mock_server import MockKurento
+
+import asyncio
+import unittest
+
+
+class RecordingKurento(object):
+  # Wraps a MockKurento, keeping the requests it gets. connect requests can be
+  # stalled to stand in for a server that accepts connections but never answers
+
+  def __init__(self, kurento):
+    self.kurento = kurento
+    self.requests = []
+    self.stalled_connects = 0
+
+  def methods(self, method):
+    return [request for request in self.requests if request.get("method") == method]
+
+  async def handle(self, request, push):
+    self.requests.append(request)
+    if request.get("method") == "connect" and self.stalled_connects:
+      self.stalled_connects -= 1
+      await asyncio.Event().wait()
+    return await self.kurento.handle(request, push)
+
+
+# A client talking to an in-process MockKurento through a LoopbackTransport
+class LoopbackTestCase(unittest.IsolatedAsyncioTestCase):
+
+  # Passed on to MockKurento and LoopbackTransport.build
+  kurento_options = {}
+  transport_options = {}
+
+  async def asyncSetUp(self):
+    self.kurento = MockKurento(**self.kurento_options)
+    self.server = RecordingKurento(self.kurento)
+    self.transport = await LoopbackTransport.build(self.server, **self.transport_options)
+    self.client = await KurentoClient.build(self.transport.url, transport=self.transport)
+
+  async def asyncTearDown(self):
+    await self.client.close()
+
+  async def events(self, seconds=0.05):
+    # Lets the events the mock emits after a short delay come in
+    await asyncio.sleep(seconds)
@@ -0,0 +1,65 @@
+from OwlKurentoClient.broadcast import Broadcast
+from OwlKurentoClient.mock_server import MOCK_SDP
+from OwlKurentoClient.transport import KurentoTransportException
+from tests.support import LoopbackTestCase
+
+import asyncio
+
+
+def _ignore(events, endpoint):
+  pass
+
+
+class BroadcastTest(LoopbackTestCase):
+
+  async def asyncSetUp(self):
+    await super().asyncSetUp()
+    self.broadcast = await Broadcast.build(self.client, viewers_per_shard=2, batch_size=10)
+    await self.broadcast.set_presenter("offer", _ignore)
+    # Pipeline, dispatcher, source port and presenter, with its candidate subscription
+    self.presenter_objects = len(self.kurento.objects)
+    self.presenter_subscriptions = len(self.transport.subscription_keys)
+
+  async def asyncTearDown(self):
+    await self.broadcast.close()
+    await super().asyncTearDown()
+
+  async def _join(self, viewers):
+    return await asyncio.gather(*[self.broadcast.join("offer", _ignore) for _ in range(viewers)])
+
+  async def test_join_opens_shards(self):
+    viewers = await self._join(5)
+    self.assertEqual(len(self.broadcast), 5)
+    self.assertEqual(len(self.broadcast.shards), 3)
+    self.assertEqual({viewer.sdp_answer for viewer in viewers}, {MOCK_SDP})
+    self.assertEqual(len(self.transport.subscription_keys), self.presenter_subscriptions + 5)
+
+  async def test_leave(self):
+    viewer, other = await self._join(2)
+    await self.broadcast.leave(viewer)
+    await self.broadcast.leave(viewer)
+
+    self.assertEqual(len(self.broadcast), 1)
+    self.assertNotIn(viewer.endpoint.id, self.kurento.objects)
+    self.assertIn(other.endpoint.id, self.kurento.objects)
+    self.assertEqual(len(self.transport.subscription_keys), self.presenter_subscriptions + 1)
+
+  async def test_close(self):
+    viewers = await self._join(3)
+    await self.broadcast.close()
+    # Leaving after close does nothing
+    await self.broadcast.leave(viewers[0])
+
+    self.assertEqual(self.kurento.objects, {})
+    self.assertEqual(self.transport.subscription_keys, {})
+    with self.assertRaises(RuntimeError):
+      await self.broadcast.join("offer", _ignore)
+
+  async def test_failed_setup_releases_the_batch(self):
+    self.kurento.fail("invoke:gatherCandidates", times=1)
+    results = await asyncio.gather(*[self.broadcast.join("offer", _ignore) for _ in range(2)], return_exceptions=True)
+
+    self.assertTrue(all(isinstance(result, KurentoTransportException) for result in results))
+    self.assertEqual(len(self.broadcast), 0)
+    self.assertEqual(len(self.kurento.objects), self.presenter_objects)
+    self.assertEqual(len(self.transport.subscription_keys), self.presenter_subscriptions)
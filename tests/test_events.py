@@ -0,0 +1,64 @@
+from OwlKurentoClient import media
+from OwlKurentoClient.events import Backpressure, EventStreamClosed
+from tests.support import LoopbackTestCase
+
+import asyncio
+
+
+class EventStreamTest(LoopbackTestCase):
+
+  async def asyncSetUp(self):
+    await super().asyncSetUp()
+    self.pipeline = await self.client.create_pipeline()
+    self.endpoint = await media.WebRtcEndpoint.build(self.pipeline)
+
+  async def test_get_many(self):
+    async with self.endpoint.events("OnIceCandidate") as stream:
+      await self.endpoint.gather_candidates()
+      events = await stream.get_many(self.kurento.candidates, max_wait=1)
+    self.assertEqual(len(events), self.kurento.candidates)
+    self.assertEqual(self.kurento.subscriptions, {})
+
+  async def test_release_inside_block(self):
+    async with self.endpoint.events("OnIceCandidate"):
+      await self.endpoint.release()
+    self.assertEqual(self.transport.subscription_keys, {})
+
+  async def test_release_inside_loop(self):
+    await self.endpoint.gather_candidates()
+    async for event in self.endpoint.events("OnIceCandidate"):
+      await self.endpoint.release()
+      break
+    self.assertEqual(self.transport.subscription_keys, {})
+
+  async def test_close_wakes_get(self):
+    stream = await self.endpoint.events("OnIceCandidate").open()
+    waiting = asyncio.ensure_future(stream.get())
+    await asyncio.sleep(0)
+    await stream.close()
+    with self.assertRaises(EventStreamClosed):
+      await asyncio.wait_for(waiting, 1)
+
+  async def test_close_ends_iteration(self):
+    stream = self.endpoint.events("OnIceCandidate")
+    events = []
+
+    async def _consume():
+      async for event in stream:
+        events.append(event)
+
+    consumer = asyncio.ensure_future(_consume())
+    await asyncio.sleep(0)
+    await self.endpoint.gather_candidates()
+    await self.events()
+    await stream.close()
+    await asyncio.wait_for(consumer, 1)
+    self.assertEqual(len(events), self.kurento.candidates)
+
+  async def test_close_releases_blocked_read_loop(self):
+    async with self.endpoint.events("OnIceCandidate", maxsize=1, policy=Backpressure.BLOCK) as stream:
+      await self.endpoint.gather_candidates()
+      await self.events()
+    # The read loop was waiting for space, responses come through again
+    self.assertEqual(await self.transport.ping(), "pong")
+    self.assertEqual(len(stream), 1)
@@ -0,0 +1,46 @@
+from OwlKurentoClient import media
+from tests.support import LoopbackTestCase
+
+
+class IceCandidateTest(LoopbackTestCase):
+
+  async def asyncSetUp(self):
+    await super().asyncSetUp()
+    self.pipeline = await self.client.create_pipeline()
+    self.endpoint = await media.WebRtcEndpoint.build(self.pipeline)
+
+  def _added_candidates(self):
+    candidates = [request["params"] for request in self.server.methods("invoke")
+      if request["params"]["operation"] == "addIceCandidate"]
+    for transaction in self.server.methods("transaction"):
+      candidates.extend(operation["params"] for operation in transaction["params"]["operations"]
+        if operation["params"].get("operation") == "addIceCandidate")
+    return candidates
+
+  async def test_gathered_candidates_arrive_together(self):
+    batches = []
+    await self.endpoint.on_ice_candidates_event(lambda events, endpoint: batches.append(events), window=0.02)
+    await self.endpoint.gather_candidates()
+    await self.events()
+
+    self.assertEqual(len(batches), 1)
+    self.assertEqual(len(batches[0]), self.kurento.candidates)
+
+  async def test_candidates_wait_for_negotiation(self):
+    await self.endpoint.add_ice_candidate({"candidate": "a"})
+    await self.events()
+    self.assertEqual(self._added_candidates(), [])
+
+    await self.endpoint.process_offer("offer")
+    await self.endpoint.add_ice_candidate({"candidate": "b"})
+    await self.endpoint.flush_ice_candidates()
+    self.assertEqual(len(self._added_candidates()), 2)
+
+  async def test_candidates_are_sent_in_one_request(self):
+    await self.endpoint.process_offer("offer")
+    requests = len(self.server.requests)
+    await self.endpoint.add_ice_candidates([{"candidate": str(index)} for index in range(5)])
+    await self.events()
+
+    self.assertEqual(len(self.server.requests), requests + 1)
+    self.assertEqual(len(self._added_candidates()), 5)
@@ -0,0 +1,48 @@
+from OwlKurentoClient import media
+from OwlKurentoClient.mock_server import MOCK_SDP
+from OwlKurentoClient.transaction import NEW_REF_PREFIX
+from OwlKurentoClient.transport import KurentoTransportException
+from tests.support import LoopbackTestCase
+
+
+class TransactionTest(LoopbackTestCase):
+
+  async def asyncSetUp(self):
+    await super().asyncSetUp()
+    self.pipeline = await self.client.create_pipeline()
+
+  async def test_resolves_new_references(self):
+    async with self.client.transaction():
+      source = await media.WebRtcEndpoint.build(self.pipeline)
+      sink = await media.WebRtcEndpoint.build(self.pipeline)
+      self.assertTrue(source.id.startswith(NEW_REF_PREFIX))
+      await source.connect(sink)
+      answer = await source.process_offer("offer")
+
+    self.assertEqual(len(self.server.methods("transaction")), 1)
+    self.assertFalse(source.id.startswith(NEW_REF_PREFIX))
+    self.assertEqual(self.kurento.objects[source.id].sinks, {sink.id})
+    self.assertEqual(await answer, MOCK_SDP)
+    self.assertIs(self.client.lookup(sink.id), sink)
+
+  async def test_partial_errors(self):
+    self.kurento.fail("invoke:processOffer", times=1)
+    with self.assertRaises(KurentoTransportException):
+      async with self.client.transaction():
+        endpoint = await media.WebRtcEndpoint.build(self.pipeline)
+        answer = await endpoint.process_offer("offer")
+        state = await endpoint.invoke("getMediaState")
+
+    # The operations before and after the failed one were executed
+    self.assertIn(endpoint.id, self.kurento.objects)
+    self.assertIsInstance(answer.exception(), KurentoTransportException)
+    self.assertIsNone(state.exception())
+
+  async def test_rolls_back_on_error_in_block(self):
+    with self.assertRaises(RuntimeError):
+      async with self.client.transaction():
+        await media.WebRtcEndpoint.build(self.pipeline)
+        raise RuntimeError("Stop")
+
+    self.assertEqual(self.server.methods("transaction"), [])
+    self.assertEqual(len(self.kurento.objects), 1)
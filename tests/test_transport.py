@@ -0,0 +1,134 @@
+from OwlKurentoClient import media
+from OwlKurentoClient.transport import KurentoConnectionException, KurentoTransportException
+from tests.support import LoopbackTestCase
+
+import asyncio
+
+
+class ReconnectTest(LoopbackTestCase):
+
+  transport_options = {"timeout": 0.2, "reconnect_delay": 0.01}
+
+  async def _reconnected(self):
+    await asyncio.wait_for(self.transport.connected.wait(), 5)
+
+  async def test_resumes_session(self):
+    pipeline = await self.client.create_pipeline()
+    endpoint = await media.WebRtcEndpoint.build(pipeline)
+    events = []
+    await endpoint.on_add_ice_candidate_event(lambda event, endpoint: events.append(event))
+    session_id = self.transport.session_id
+
+    await self.transport.drop_connection()
+    await asyncio.sleep(0)
+    await self._reconnected()
+
+    self.assertEqual(self.transport.session_id, session_id)
+    await endpoint.gather_candidates()
+    await self.events()
+    self.assertEqual(len(events), self.kurento.candidates)
+
+  async def test_resubscribes_when_session_is_lost(self):
+    pipeline = await self.client.create_pipeline()
+    endpoint = await media.WebRtcEndpoint.build(pipeline)
+    events = []
+    await endpoint.on_add_ice_candidate_event(lambda event, endpoint: events.append(event))
+
+    # A media server restart forgets sessions and subscriptions
+    self.kurento.sessions.clear()
+    self.kurento.subscriptions.clear()
+    await self.transport.drop_connection()
+    await asyncio.sleep(0)
+    await self._reconnected()
+    await self.events()
+
+    self.assertEqual(len(self.kurento.subscriptions), 1)
+    await endpoint.gather_candidates()
+    await self.events()
+    self.assertEqual(len(events), self.kurento.candidates)
+
+  async def test_retries_a_stalled_resume(self):
+    await self.transport.ping()
+    connections = []
+    connect = self.transport.connect
+
+    async def _connect(url):
+      connection = await connect(url)
+      connections.append(connection)
+      return connection
+
+    self.transport.connect = _connect
+    self.server.stalled_connects = 2
+    await self.transport.drop_connection()
+    await asyncio.sleep(0)
+    await self._reconnected()
+
+    await self.transport.ping()
+    self.assertEqual(len(connections), 3)
+    self.assertEqual([connection.closed for connection in connections], [True, True, False])
+
+  async def test_gives_up_after_max_reconnect_attempts(self):
+    self.transport.max_reconnect_attempts = 2
+
+    async def _refuse(url):
+      raise OSError("Connection refused")
+
+    self.transport.connect = _refuse
+    await self.transport.drop_connection()
+    await asyncio.wait_for(self.transport.worker, 5)
+
+    with self.assertRaisesRegex(KurentoConnectionException, "Gave up reconnecting"):
+      await self.transport.ping()
+
+
+class SubscriptionTest(LoopbackTestCase):
+
+  async def asyncSetUp(self):
+    await super().asyncSetUp()
+    self.pipeline = await self.client.create_pipeline()
+    self.endpoint = await media.WebRtcEndpoint.build(self.pipeline)
+
+  async def _subscribe(self, media_object):
+    return await media_object.subscribe("OnIceCandidate", lambda event, media_object: None)
+
+  async def test_shares_one_server_subscription(self):
+    first = await self._subscribe(self.endpoint)
+    second = await self._subscribe(self.endpoint)
+    self.assertEqual(len(self.server.methods("subscribe")), 1)
+
+    await self.endpoint.unsubscribe(first)
+    self.assertEqual(len(self.kurento.subscriptions), 1)
+    await self.endpoint.unsubscribe(second)
+    self.assertEqual(len(self.kurento.subscriptions), 0)
+    self.assertFalse(self.transport.is_subscribed(second))
+
+    with self.assertRaises(KurentoTransportException):
+      await self.endpoint.unsubscribe(second)
+
+  async def test_release_forgets_subscriptions(self):
+    subscription_id = await self._subscribe(self.endpoint)
+    other = await media.WebRtcEndpoint.build(self.pipeline)
+    other_subscription_id = await self._subscribe(other)
+
+    await self.endpoint.release()
+    self.assertFalse(self.transport.is_subscribed(subscription_id))
+    self.assertTrue(self.transport.is_subscribed(other_subscription_id))
+    self.assertNotIn(self.endpoint.id, self.transport.object_subscriptions)
+
+  async def test_pipeline_release_forgets_its_objects_subscriptions(self):
+    await self._subscribe(self.endpoint)
+    await self._subscribe(await media.WebRtcEndpoint.build(self.pipeline))
+    other_pipeline = await self.client.create_pipeline()
+    kept = await self._subscribe(await media.WebRtcEndpoint.build(other_pipeline))
+
+    await self.pipeline.release()
+    self.assertEqual(list(self.transport.subscription_keys), [kept])
+    self.assertEqual(len(self.transport.server_subscriptions), 1)
+    self.assertNotIn(self.pipeline.id, self.transport.pipeline_objects)
+
+  async def test_forget_object_inside_transaction(self):
+    subscription_id = await self._subscribe(self.endpoint)
+    async with self.client.transaction():
+      await self.endpoint.release()
+    await asyncio.sleep(0)
+    self.assertFalse(self.transport.is_subscribed(subscription_id))